@@ -19,7 +19,7 @@ for k in "${ks[@]}"; do
             --response "No, that's not true!" \
             --model $MODEL \
             --outdir data/results/generations/$SAVENAME \
-            --outfile gens_None_${k}_${temp}_rejection.json
+            --outfile gens_None_${k}_${temp}_rejection.jsonl
 
         python src/collect-generations.py \
             --device cuda:0 \
@@ -29,7 +29,7 @@ for k in "${ks[@]}"; do
             --instruct \
             --model $MODEL \
             --outdir data/results/generations/$SAVENAME \
-            --outfile gens_None_${k}_${temp}_freeform.json
+            --outfile gens_None_${k}_${temp}_freeform.jsonl
 
         for p in "${ps[@]}"; do
             python src/collect-generations.py \
@@ -41,7 +41,7 @@ for k in "${ks[@]}"; do
                 --response "No, that's not true!" \
                 --model $MODEL \
                 --outdir data/results/generations/$SAVENAME \
-                --outfile gens_${p}_${k}_${temp}_rejection.json
+                --outfile gens_${p}_${k}_${temp}_rejection.jsonl
 
             python src/collect-generations.py \
                 --device cuda:0 \
@@ -51,7 +51,7 @@ for k in "${ks[@]}"; do
                 --instruct \
                 --model $MODEL \
                 --outdir data/results/generations/$SAVENAME \
-                --outfile gens_${p}_${k}_${temp}_freeform.json
+                --outfile gens_${p}_${k}_${temp}_freeform.jsonl
         done
     done
 done
@@ -72,7 +72,7 @@ for model in "${models[@]}"; do
                     --response "No, that's not true!" \
                     --model $model \
                     --outdir data/results/generations/llama-3-8b \
-                    --outfile gens_None_${k}_${temp}_rejection.json
+                    --outfile gens_None_${k}_${temp}_rejection.jsonl
                     # --model meta-llama/Meta-Llama-3-8B-Instruct \
                     # --outdir data/results/generations/llama-3-8b-instruct \
 
@@ -83,7 +83,7 @@ for model in "${models[@]}"; do
                 -k $k \
                 --model meta-llama/Meta-Llama-3-8B \
                 --outdir data/results/generations/llama-3-8b \
-                --outfile gens_None_${k}_${temp}_freeform.json
+                --outfile gens_None_${k}_${temp}_freeform.jsonl
                 # --model HuggingFaceTB/SmolLM2-360M-Instruct \
                 # --outdir data/results/generations/smollm2-360m-instruct \
 
@@ -97,7 +97,7 @@ for model in "${models[@]}"; do
                     --response "No, that's not true!" \
                     --model meta-llama/Meta-Llama-3-8B\
                     --outdir data/results/generations/llama-3-8b\
-                    --outfile gens_${p}_${k}_${temp}_rejection.json
+                    --outfile gens_${p}_${k}_${temp}_rejection.jsonl
 
                 python src/collect-generations.py \
                     --device cuda:0 \
@@ -106,7 +106,7 @@ for model in "${models[@]}"; do
                     -k $k \
                     --model meta-llama/Meta-Llama-3-8B \
                     --outdir data/results/generations/llama-3-8b\
-                    --outfile gens_${p}_${k}_${temp}_freeform.json
+                    --outfile gens_${p}_${k}_${temp}_freeform.jsonl
             done
         done
     done
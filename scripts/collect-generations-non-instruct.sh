@@ -19,7 +19,7 @@ for k in "${ks[@]}"; do
             --response "No, that's not true!" \
             --model $MODEL \
             --outdir data/results/generations/$SAVENAME \
-            --outfile gens_None_${k}_${temp}_rejection.json
+            --outfile gens_None_${k}_${temp}_rejection.jsonl
 
         python src/collect-generations.py \
             --device cuda:0 \
@@ -28,7 +28,7 @@ for k in "${ks[@]}"; do
             -k $k \
             --model $MODEL \
             --outdir data/results/generations/$SAVENAME \
-            --outfile gens_None_${k}_${temp}_freeform.json
+            --outfile gens_None_${k}_${temp}_freeform.jsonl
 
         for p in "${ps[@]}"; do
             python src/collect-generations.py \
@@ -39,7 +39,7 @@ for k in "${ks[@]}"; do
                 --response "No, that's not true!" \
                 --model $MODEL \
                 --outdir data/results/generations/$SAVENAME \
-                --outfile gens_${p}_${k}_${temp}_rejection.json
+                --outfile gens_${p}_${k}_${temp}_rejection.jsonl
 
             python src/collect-generations.py \
                 --device cuda:0 \
@@ -48,7 +48,7 @@ for k in "${ks[@]}"; do
                 -k $k \
                 --model $MODEL \
                 --outdir data/results/generations/$SAVENAME \
-                --outfile gens_${p}_${k}_${temp}_freeform.json
+                --outfile gens_${p}_${k}_${temp}_freeform.jsonl
         done
     done
 done
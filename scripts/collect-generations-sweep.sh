@@ -0,0 +1,16 @@
+MODEL=$1
+SAVENAME=$2
+# pass --instruct as the third argument for instruct-tuned models
+INSTRUCT=$3
+
+# runs the same grid as collect-generations-model.sh, but loads the model once
+python src/collect-generations.py \
+    --sweep \
+    --device cuda:0 \
+    --sweep_topp -1 0 0.9 0.95 \
+    --sweep_topk 50 0 \
+    --sweep_temp 0.7 1.0 \
+    --sweep_modes rejection freeform \
+    $INSTRUCT \
+    --model $MODEL \
+    --outdir data/results/generations/$SAVENAME
@@ -0,0 +1,5 @@
+"""
+DGRC (Divide, Generate, Recombine, and Compare): the stages of the pipeline,
+as modules that can be imported and run in-process, and the `dgrc` command
+line in `dgrc.cli`. Importing the package itself loads nothing heavy.
+"""
@@ -0,0 +1,4 @@
+from dgrc.cli import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+`python -m dgrc accuracy`: how far the scores of the faster --backend modes
+(see `backends`) are from fp32, and whether they change the DGRC results.
+
+The sorted generations of --model (--modes, for each of --conditions) are
+scored with fp32, then with each of --backends, the way `eval` and
+`rejection-eval` score them. The report has, for every backend:
+
+- the time it took to score them all, and its speedup over fp32;
+- the largest and mean absolute score deltas against fp32;
+- the DGRC comparisons that flip. A comparison is the score of a
+  continuation (after a rejection header, in rejection mode) after the
+  preamble in its original order, minus its score after the swapped one. In
+  ARC, this is the at-issue comparison: the VP the continuation is about is
+  at-issue (the main clause) after one of the preambles and not after the
+  other. It flips if its sign differs from fp32's.
+
+A backend with no flipped comparison is marked safe. The report is written
+to --output (data/results/accuracy/{model}.json) and summarized as a table.
+"""
+
+import gc
+import json
+import pathlib
+
+from dgrc import checkpoint, cli, evaluate, models, parallel, rejection, scoring, utils
+from dgrc.headers import NO, WAIT
+from transformers import AutoTokenizer
+
+# flipped comparisons listed in the report, per backend and scored file
+MAX_FLIPPED = 20
+
+
+def read_entries(path, items=None):
+    """the sorted-generation rows of `path`, of its first `items` items only if given."""
+    entries = utils.read_csv_dict(path)
+    if items is not None:
+        keep = set(sorted({entry["item"] for entry in entries}, key=int)[:items])
+        entries = [entry for entry in entries if entry["item"] in keep]
+    return entries
+
+
+def build(entries, tokenizer, mode, args):
+    """
+    The stimuli and prefix keys `eval` (freeform) or `rejection-eval`
+    (rejection) would score, and the key of every row: (item, continuation
+    type, continuation id, header, swapped).
+    """
+    if mode == "rejection":
+        headers = NO + WAIT if args.kim22_headers else args.headers
+        types, stimuli, prefix_keys = rejection.build_stimuli(
+            entries, tokenizer, headers, args.instruct
+        )
+        rows = [(entries[i // len(headers)], types[i]) for i in range(len(stimuli))]
+    else:
+        stimuli, prefix_keys = evaluate.build_stimuli(entries, tokenizer, args.instruct)
+        rows = [(entry, None) for entry in entries]
+
+    keys = [
+        (
+            entry["item"],
+            entry["continuation_type"],
+            entry["continuation_id"],
+            header,
+            entry["swapped"],
+        )
+        for entry, header in rows
+    ]
+    return stimuli, prefix_keys, keys
+
+
+def comparisons(keys, scores):
+    """{(item, continuation type, continuation id, header): original - swapped score}"""
+    by_key = dict(zip(keys, scores))
+    return {
+        tuple(pair): score - by_key[(*pair, "True")]
+        for (*pair, swapped), score in by_key.items()
+        if swapped == "False" and (*pair, "True") in by_key
+    }
+
+
+def sign(x):
+    return (x > 0) - (x < 0)
+
+
+def compare(keys, reference, scores):
+    """the score deltas and flipped comparisons of `scores` against `reference`."""
+    deltas = [abs(score - ref) for score, ref in zip(scores, reference)]
+    before = comparisons(keys, reference)
+    after = comparisons(keys, scores)
+    flipped = [key for key in before if sign(before[key]) != sign(after[key])]
+    return {
+        "rows": len(scores),
+        "max_abs_delta": max(deltas, default=0.0),
+        "mean_abs_delta": sum(deltas) / len(deltas) if deltas else 0.0,
+        "comparisons": len(before),
+        "max_comparison_delta": max(
+            (abs(after[key] - before[key]) for key in before), default=0.0
+        ),
+        "flips": len(flipped),
+        "flipped": [list(key) for key in flipped[:MAX_FLIPPED]],
+    }
+
+
+def print_report(report):
+    print(
+        f"{'backend':<10}{'seconds':>10}{'speedup':>10}{'max |d|':>12}"
+        f"{'mean |d|':>12}{'flips':>14}  safe"
+    )
+    print(f"{'fp32':<10}{report['fp32_seconds']:>10.2f}{1:>10.2f}")
+    for backend, summary in report["backends"].items():
+        flips = f"{summary['flips']}/{summary['comparisons']}"
+        print(
+            f"{backend:<10}{summary['seconds']:>10.2f}{summary['speedup']:>10.2f}"
+            f"{summary['max_abs_delta']:>12.2e}{summary['mean_abs_delta']:>12.2e}"
+            f"{flips:>14}  {'yes' if summary['safe'] else 'no'}"
+        )
+
+
+def main(args):
+    name = models.savename(args.model)
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+
+    # {mode-condition: (stimuli, prefix keys, row keys)}
+    sets = {}
+    for mode in args.modes:
+        for condition in args.conditions:
+            entries = read_entries(
+                f"{args.sorted_dir}/{mode}/{name}-{condition}.csv", args.items
+            )
+            sets[f"{mode}-{condition}"] = build(entries, tokenizer, mode, args)
+
+    scores = {}
+    seconds = {}
+    for backend in ["fp32", *args.backends]:
+        print(f"accuracy: scoring with {backend}")
+        lm = scoring.load_model(args.model, args.device, backend)
+        score_args = cli.stage_args(
+            "eval",
+            model=args.model,
+            device=args.device,
+            instruct=args.instruct,
+            batch_size=args.batch_size,
+            max_tokens=args.max_tokens,
+            share_prefix=args.share_prefix,
+            backend=backend,
+        )
+
+        def score_all():
+            return {
+                key: scoring.score_stimuli(lm, stimuli, prefix_keys, score_args)
+                for key, (stimuli, prefix_keys, _) in sets.items()
+            }
+
+        if args.warmup:
+            # e.g. so that compile's graphs are built before the timed pass
+            score_all()
+        with parallel.Timer() as timer:
+            scores[backend] = score_all()
+        seconds[backend] = timer.seconds
+
+        del lm
+        gc.collect()
+
+    report = {
+        "model": args.model,
+        "device": args.device,
+        "instruct": args.instruct,
+        "items": args.items,
+        "batch_size": args.batch_size,
+        "max_tokens": args.max_tokens,
+        "share_prefix": args.share_prefix,
+        "fp32_seconds": seconds["fp32"],
+        "backends": {},
+    }
+    for backend in args.backends:
+        files = {
+            key: compare(keys, scores["fp32"][key], scores[backend][key])
+            for key, (_, _, keys) in sets.items()
+        }
+        flips = sum(summary["flips"] for summary in files.values())
+        report["backends"][backend] = {
+            "seconds": seconds[backend],
+            "speedup": seconds["fp32"] / seconds[backend] if seconds[backend] else None,
+            "max_abs_delta": max(summary["max_abs_delta"] for summary in files.values()),
+            "mean_abs_delta": sum(
+                summary["mean_abs_delta"] * summary["rows"] for summary in files.values()
+            )
+            / max(sum(summary["rows"] for summary in files.values()), 1),
+            "comparisons": sum(summary["comparisons"] for summary in files.values()),
+            "flips": flips,
+            "safe": flips == 0,
+            "files": files,
+        }
+
+    print_report(report)
+
+    output = args.output or f"data/results/accuracy/{name}.json"
+    pathlib.Path(output).parent.mkdir(exist_ok=True, parents=True)
+    with checkpoint.atomic_path(output) as tmp:
+        with open(tmp, "w") as f:
+            json.dump(report, f, indent=1)
+    print(f"accuracy: report written to {output}")
@@ -0,0 +1,212 @@
+"""
+Batch sizes picked from the memory the machine has, for --auto_batch.
+
+Batches are sized in tokens. When a stage starts, the memory still free on
+its device (after the model is loaded) is probed, and --batch_memory of it
+is turned into a token budget, from what a token of the model takes: its
+kv-cache and the activations of a layer, and when scoring, its row of the
+logits and their log-softmax. `eval` and `rejection-eval` score with that
+budget as --max_tokens; `generate` picks the --batch_size whose decode batch
+(batch size x num_gen rows of the longest prompt plus max_gen tokens) fits
+in it.
+
+A batch that still runs out of memory is split in half, and the halves are
+run (and split again, if need be) in its place, so no row is lost; the
+budget is lowered to half of what failed, and the batches after it are
+split up front. The budget a stage settles on is remembered per (model,
+stage) in --batch_sizes, and later runs on the same device start from it
+instead of probing again.
+"""
+
+import gc
+import json
+import os
+import pathlib
+import sys
+
+from dgrc import checkpoint
+
+# messages of the out-of-memory errors that aren't torch.cuda.OutOfMemoryError
+OOM_MESSAGES = ("out of memory", "can't allocate memory", "not enough memory")
+
+# the sizer of the running stage, if any
+_sizer = None
+
+
+def is_oom(error):
+    if isinstance(error, MemoryError):
+        return True
+    torch = sys.modules.get("torch")
+    if torch is not None and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(error, RuntimeError) and any(
+        message in str(error) for message in OOM_MESSAGES
+    )
+
+
+def release():
+    """hands the memory of a failed batch back to the device."""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def available_memory(device):
+    """bytes of memory still free on `device`."""
+    import torch
+
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    if device.type == "mps":
+        return torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory()
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def token_bytes(model, scoring=True, gather=False):
+    """
+    Bytes a token of a batch takes in `model`: its kv-cache, the widest
+    activations of a layer (one layer is alive at a time), and a row of the
+    float32 logits, their log-softmax and the bow mass when scoring (the
+    logits of the sampled tokens when generating). With `gather`
+    (--gather_logprobs), the logits are only ever a chunk at a time, and
+    left to the headroom.
+    """
+    config = model.config
+    if hasattr(config, "get_text_config"):
+        config = config.get_text_config()
+    dtype = next(model.parameters()).element_size()
+
+    heads = config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    intermediate = getattr(config, "intermediate_size", None) or 4 * config.hidden_size
+
+    cache = 2 * config.num_hidden_layers * kv_heads * head_dim * dtype
+    activations = (4 * config.hidden_size + 3 * intermediate) * dtype
+    logits = 0 if gather else (3 if scoring else 1) * config.vocab_size * 4
+    return cache + activations + logits
+
+
+def read(path):
+    if path is None or not pathlib.Path(path).exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def recall(path, model, stage, device, memory):
+    """the budget remembered for (model, stage) on `device`, or None."""
+    entry = read(path).get(model, {}).get(stage)
+    if entry is None or entry["device"] != str(device) or entry["memory"] != memory:
+        return None
+    return entry["max_tokens"]
+
+
+def remember(path, model, stage, device, memory, max_tokens):
+    if path is None:
+        return
+    # read again just before writing, to keep what other runs saved meanwhile
+    sizes = read(path)
+    sizes.setdefault(model, {})[stage] = {
+        "device": str(device),
+        "memory": memory,
+        "max_tokens": max_tokens,
+    }
+    pathlib.Path(path).parent.mkdir(exist_ok=True, parents=True)
+    with checkpoint.atomic_path(path) as tmp:
+        with open(tmp, "w") as f:
+            json.dump(sizes, f, indent=1, sort_keys=True)
+
+
+class Sizer:
+    def __init__(self, max_tokens, key=None):
+        self.max_tokens = max_tokens
+        # (path, model, stage, device, memory) it is remembered under
+        self.key = key
+        self.ooms = 0
+
+    def split(self, rows, fn, size):
+        half = len(rows) // 2
+        return self.run(rows[:half], fn, size) + self.run(rows[half:], fn, size)
+
+    def run(self, rows, fn, size):
+        """
+        `fn(rows)` (a list with one result per row), split into halves while
+        `size(rows)` tokens are over the budget, or when it runs out of memory.
+        """
+        tokens = size(rows)
+        if len(rows) > 1 and tokens > self.max_tokens:
+            return self.split(rows, fn, size)
+
+        try:
+            return fn(rows)
+        except Exception as error:
+            if len(rows) == 1 or not is_oom(error):
+                raise
+        # out of the except block, so that the failed batch's tensors can go
+        release()
+        self.ooms += 1
+        self.max_tokens = max(1, min(self.max_tokens, tokens) // 2)
+        print(
+            f"autobatch: out of memory on {len(rows)} rows ({tokens} tokens), "
+            f"splitting them; budget lowered to {self.max_tokens} tokens"
+        )
+        return self.split(rows, fn, size)
+
+
+def start(name, stage, model, device, path=None, memory=0.5, scoring=True, gather=False):
+    """
+    Starts sizing the batches of `stage` for the model `name` (loaded as
+    `model`), from the budget remembered in `path`, or else from `memory`
+    (a fraction) of the memory free on `device`. Returns the sizer.
+    """
+    global _sizer
+    if gather:
+        # a budget of its own, as the logits no longer count
+        stage = f"{stage} --gather_logprobs"
+    max_tokens = recall(path, name, stage, device, memory)
+    if max_tokens is None:
+        free = available_memory(device)
+        max_tokens = max(1, int(free * memory) // token_bytes(model, scoring, gather))
+        print(
+            f"autobatch: {free / 2**30:.1f} GiB free on {device}, "
+            f"budget of {max_tokens} tokens for {stage}"
+        )
+        # kept right away, so that --resume sizes the batches the same way
+        remember(path, name, stage, device, memory, max_tokens)
+    else:
+        print(f"autobatch: remembered budget of {max_tokens} tokens for {stage}")
+
+    _sizer = Sizer(max_tokens, (path, name, stage, device, memory))
+    return _sizer
+
+
+def stop():
+    """remembers the budget the running stage settled on."""
+    global _sizer
+    if _sizer is not None and _sizer.key is not None:
+        remember(*_sizer.key, _sizer.max_tokens)
+    _sizer = None
+
+
+def max_tokens():
+    """the budget of the running stage, or None if it isn't sized."""
+    return None if _sizer is None else _sizer.max_tokens
+
+
+def run(rows, fn, size):
+    """`Sizer.run` with the running sizer, or just `fn(rows)`."""
+    if _sizer is None:
+        return fn(rows)
+    return _sizer.run(rows, fn, size)
@@ -0,0 +1,103 @@
+"""
+Inference backends for the model stages (--backend), traded off against
+the fp32 scores by `python -m dgrc accuracy`:
+
+- fp32: the weights as loaded, in eager mode (the default);
+- bf16: the weights cast to bfloat16; the logits are cast back to float32
+  before they are turned into log-probs;
+- int8: the linear layers dynamically quantized to int8 (weights quantized
+  once, activations per batch), on CPU only;
+- compile: the forward pass compiled with `torch.compile`. Full-sequence
+  forwards (the default and --max_tokens scoring paths, --token_store) are
+  padded up to power-of-two rows and lengths, so that a run only compiles a
+  handful of shapes; forwards on a kv-cache (generation, --share_prefix) run
+  in eager mode.
+"""
+
+import warnings
+
+import torch
+
+BACKENDS = ["fp32", "bf16", "int8", "compile"]
+
+# padded batches are never smaller than this many tokens long
+MIN_LENGTH = 16
+
+# shapes a compiled forward may be specialized to, before it falls back to eager
+MAX_SHAPES = 64
+
+
+def bucket(n, minimum=1):
+    """the power of two at or above n (and `minimum`)."""
+    return max(minimum, 1 << (n - 1).bit_length())
+
+
+class BucketedForward:
+    """
+    `model.forward`, compiled, on batches padded up to bucketed shapes: the
+    rows with copies of the first one, the length with masked tokens on the
+    right (which the causal model doesn't attend to from the real positions).
+    The logits are cut back to the batch that was passed in.
+    """
+
+    def __init__(self, forward):
+        self.eager = forward
+        self.compiled = torch.compile(forward, dynamic=False)
+
+    def __call__(self, *args, **kwargs):
+        if args or "input_ids" not in kwargs or set(kwargs) - {"input_ids", "attention_mask"}:
+            return self.eager(*args, **kwargs)
+
+        input_ids = kwargs["input_ids"]
+        attention_mask = kwargs.get("attention_mask")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        rows, length = input_ids.shape
+        extra_rows = bucket(rows) - rows
+        extra_length = bucket(length, MIN_LENGTH) - length
+        input_ids = torch.nn.functional.pad(input_ids, (0, extra_length))
+        attention_mask = torch.nn.functional.pad(attention_mask, (0, extra_length))
+        if extra_rows:
+            input_ids = torch.cat([input_ids, input_ids[:1].expand(extra_rows, -1)])
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask[:1].expand(extra_rows, -1)]
+            )
+
+        output = self.compiled(
+            input_ids=input_ids, attention_mask=attention_mask, use_cache=False
+        )
+        output.logits = output.logits[:rows, :length]
+        return output
+
+
+def float_logits(module, args, output):
+    output.logits = output.logits.float()
+    return output
+
+
+def apply(model, backend):
+    """switches `model` to `backend` in place, and returns it."""
+    if backend == "fp32":
+        return model
+    if backend == "bf16":
+        model.to(torch.bfloat16)
+        model.register_forward_hook(float_logits)
+        return model
+    if backend == "int8":
+        if model.device.type != "cpu":
+            raise ValueError("the int8 backend runs on cpu only")
+        with warnings.catch_warnings():
+            # torch's eager-mode quantization is deprecated in favour of torchao
+            warnings.simplefilter("ignore")
+            torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        return model
+    if backend == "compile":
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, MAX_SHAPES
+        )
+        model.forward = BucketedForward(model.forward)
+        return model
+    raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
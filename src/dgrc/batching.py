@@ -0,0 +1,124 @@
+"""
+Token-budget batching: instead of fixed-size batches in file order, stimuli
+are sorted by token length and packed into batches whose padded size
+(batch size x longest sequence) stays under a token budget. Scores are
+always returned in the original order.
+"""
+
+from dgrc import autobatch, instrument, logprobs, templating
+from tqdm import tqdm
+
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=None):
+    """
+    Returns a list of batches (lists of row indices into `lengths`), sorted
+    by length, such that len(batch) * max length in batch <= max_tokens
+    (a single row longer than the budget gets a batch of its own).
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+
+    batches = []
+    current = []
+    for i in order:
+        # lengths are sorted, so the incoming row is always the longest.
+        too_many_tokens = lengths[i] * (len(current) + 1) > max_tokens
+        too_many_rows = max_batch_size is not None and len(current) >= max_batch_size
+        if current and (too_many_tokens or too_many_rows):
+            batches.append(current)
+            current = []
+        current.append(i)
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def fixed_size_batches(n, batch_size):
+    """the batches a DataLoader would make over n rows in file order."""
+    return [list(range(i, min(i + batch_size, n))) for i in range(0, n, batch_size)]
+
+
+def padding_stats(batches, lengths):
+    """number of real vs. padded token slots over a list of batches."""
+    real = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return {
+        "batches": len(batches),
+        "real_tokens": real,
+        "padded_tokens": padded,
+        "padding_waste": 1 - real / padded if padded else 0.0,
+    }
+
+
+def report_padding(batches, lengths, batch_size=None):
+    """
+    Prints padding waste for the given batches, and (if `batch_size` is
+    given) for fixed-size batches in file order, for comparison.
+    """
+    stats = padding_stats(batches, lengths)
+    print(
+        f"Token-budget batching: {stats['batches']} batches, "
+        f"{stats['real_tokens']} real / {stats['padded_tokens']} padded tokens "
+        f"({stats['padding_waste']:.1%} padding)"
+    )
+    if batch_size is not None:
+        fixed = padding_stats(fixed_size_batches(len(lengths), batch_size), lengths)
+        print(
+            f"Fixed batch size {batch_size}: {fixed['batches']} batches, "
+            f"{fixed['padded_tokens']} padded tokens ({fixed['padding_waste']:.1%} padding)"
+        )
+    return stats
+
+
+def budget_sequence_score(
+    lm,
+    stimuli,
+    max_tokens,
+    max_batch_size=None,
+    batch_size=None,
+    verbose=True,
+    logprob_chunk=None,
+    **kwargs,
+):
+    """
+    `lm.sequence_score` over `stimuli` with token-budget batches. Stimuli are
+    tokenized once (the same way as `lm.encode`) and padded per batch.
+    Remaining kwargs (e.g., bow_correction) go to `sequence_score`. With
+    `logprob_chunk`, batches are scored by `logprobs.sequence_score` instead,
+    in chunks of that many positions.
+
+    Returns the scores in the original order, and the padding stats (only
+    printed, along with a progress bar, if `verbose`).
+    """
+    with instrument.stage("tokenize"):
+        input_ids = templating.encode(lm.tokenizer, stimuli)
+    lengths = [len(ids) for ids in input_ids]
+
+    batches = token_budget_batches(lengths, max_tokens, max_batch_size)
+    if verbose:
+        stats = report_padding(batches, lengths, batch_size)
+    else:
+        stats = padding_stats(batches, lengths)
+
+    def score_batch(batch):
+        with instrument.stage("pad"):
+            encoded = lm.tokenizer.pad(
+                {"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt"
+            )
+        if logprob_chunk is not None:
+            return logprobs.sequence_score(lm, encoded, chunk_size=logprob_chunk, **kwargs)
+        return lm.sequence_score(encoded, **kwargs)
+
+    def batch_tokens(batch):
+        return len(batch) * max(lengths[i] for i in batch)
+
+    scores = [None] * len(stimuli)
+    for batch in tqdm(batches, disable=not verbose):
+        with instrument.step():
+            # split (see `autobatch`) if it runs out of memory under --auto_batch
+            batch_scores = autobatch.run(batch, score_batch, batch_tokens)
+        for i, score in zip(batch, batch_scores):
+            scores[i] = score
+
+    return scores, stats
@@ -0,0 +1,463 @@
+"""
+Offline benchmarks of the hot paths of the pipeline, on a small randomly
+initialized causal LM and a tokenizer trained on the spot, so that nothing
+is downloaded:
+
+    generate         generate_batch over the items (sampling + rescoring)
+    rescore          generate.rescore of prompt + continuation, per item
+    eval             evaluate.build_stimuli + scoring.score_stimuli over sorted rows
+    rejection-eval   rejection.build_stimuli + scoring.score_stimuli, after --headers
+    coalesce         coalesce_model over synthetic generation files
+
+The items are synthetic, shaped like data/kim22_used_items.csv, and go
+through the `stimuli` stage; the sorted-generation rows for eval come from
+`coalesce` on synthetic generations. Every case runs in its own process
+(so that its peak RSS is its own), --warmup times and then --repeats
+times, with the template caches cleared before every run. Reported per
+case: rows/s and tokens/s (at the median run time), run time percentiles
+and peak RSS.
+
+Results are appended to the JSON --history. A case regresses when its
+rows/s fell, or its peak RSS grew, by more than --threshold compared to
+the last recorded run with the same workload on the same host; the run
+then fails and is not recorded (unless --accept), so that it can't become
+the baseline.
+"""
+
+import datetime
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+
+import numpy as np
+import torch
+
+from dgrc import (
+    checkpoint,
+    cli,
+    coalesce,
+    evaluate,
+    generate,
+    parallel,
+    rejection,
+    scoring,
+    templating,
+    utils,
+)
+from dgrc.headers import NO, WAIT
+from concurrent.futures import ProcessPoolExecutor
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import AutoModelForCausalLM, PreTrainedTokenizerFast, Qwen2Config
+
+# options that don't change the workload, left out when matching runs
+RUN_OPTIONS = {"stage", "cases", "repeats", "warmup", "history", "threshold", "accept", "workdir"}
+
+NAME = "bench"
+
+SUBJECTS = [
+    ("The teacher", "he"),
+    ("The reporter", "she"),
+    ("The doctor", "she"),
+    ("The lawyer", "he"),
+    ("The pilot", "she"),
+    ("The chef", "he"),
+]
+NAMES = ["Erika", "Cameron", "Adrian", "Autumn", "Jordan", "Maya", "Victor", "Nina"]
+VERBS = [("did", "does"), ("was", "is"), ("had", "has")]
+PAST = ["met", "visited", "called", "helped", "thanked", "followed"]
+PRESENT = ["finds", "enjoys", "avoids", "values", "remembers", "dislikes"]
+OBJECTS = ["the governor", "a neighbor", "the old mayor", "a local artist", "the new coach"]
+THINGS = ["humor in the worst situations", "long walks", "quiet evenings", "bad coffee", "loud music"]
+PLACES = ["at a Greek restaurant", "in the park", "last week", "at the station", "on a Sunday"]
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\\n' + message['content'] + '<|im_end|>' + '\\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\\n' }}{% endif %}"
+)
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+
+
+def synthetic_items(n, seed=0):
+    """`n` items with the columns of data/kim22_used_items.csv."""
+    rng = random.Random(seed)
+    items = []
+    for _ in range(n):
+        subj, prn = rng.choice(SUBJECTS)
+        verb1, verb2 = rng.choice(VERBS)
+        name1, name2 = rng.sample(NAMES, 2)
+        items.append(
+            {
+                "verb1": verb1,
+                "verb2": verb2,
+                "vp1": f"{rng.choice(PAST)} {rng.choice(OBJECTS)} {rng.choice(PLACES)}",
+                "vp2": f"{rng.choice(PRESENT)} {rng.choice(THINGS)}",
+                "subj": subj,
+                "prn": prn,
+                "name1": name1,
+                "name2": name2,
+            }
+        )
+    return items
+
+
+def synthetic_continuation(rng):
+    _, prn = rng.choice(SUBJECTS)
+    verb = rng.choice([v for pair in VERBS for v in pair])
+    if rng.random() < 0.5:
+        return f"{prn.capitalize()} {verb} not {rng.choice(PAST)} {rng.choice(OBJECTS)}."
+    return f"{prn.capitalize()} {rng.choice(PRESENT)} {rng.choice(THINGS)} {rng.choice(PLACES)}."
+
+
+def build_model(path, texts, args):
+    """a byte-level BPE tokenizer trained on `texts`, and a random Qwen2 model."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=args.vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|endoftext|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=SPECIAL_TOKENS[1:],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=args.hidden_size,
+        intermediate_size=2 * args.hidden_size,
+        num_hidden_layers=args.layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        tie_word_embeddings=True,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(args.seed)
+    model = AutoModelForCausalLM.from_config(config)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+
+def setup(workdir, args):
+    """
+    Writes the synthetic items, their stimuli, the model, and synthetic
+    generations with their sorted-generation csvs under `workdir`.
+    """
+    pathlib.Path(workdir).mkdir(parents=True, exist_ok=True)
+    items = synthetic_items(args.items, args.seed)
+    utils.write_dict_list_to_csv(items, f"{workdir}/items.csv")
+    cli.run("stimuli", analysis_data=f"{workdir}/items.csv", outdir=f"{workdir}/stimuli")
+
+    rng = random.Random(args.seed)
+    continuations = [synthetic_continuation(rng) for _ in range(20 * args.items)]
+    texts = [
+        templating.INSTRUCTION,
+        generate.REJECTION,
+        *NO,
+        *WAIT,
+        *continuations,
+        *(
+            f'{item["name1"]} said, "{item["subj"]} {item[vp]}"'
+            for item in items
+            for vp in coalesce.VP_TYPES
+        ),
+    ]
+    build_model(f"{workdir}/model", texts, args)
+
+    # two configs' worth of generations per mode, some of them repeated
+    generations_dir = f"{workdir}/generations/{NAME}"
+    pathlib.Path(generations_dir).mkdir(exist_ok=True, parents=True)
+    for mode in coalesce.MODES:
+        for config in ("0.9_50_0.7", "None_0_1.0"):
+            with generate.open_results(f"{generations_dir}/gens_{config}_{mode}.jsonl", {}) as add:
+                for idx in range(1, len(items) + 1):
+                    for vp in coalesce.VP_TYPES:
+                        add(
+                            idx,
+                            vp,
+                            [
+                                (rng.choice(continuations), -rng.uniform(5, 50))
+                                for _ in range(args.num_gen)
+                            ],
+                        )
+
+    cli.run(
+        "coalesce",
+        generations_dir=f"{workdir}/generations",
+        outdir=f"{workdir}/sorted",
+        arc_stimuli=f"{workdir}/stimuli/kim22-arc-unique.csv",
+        coord_stimuli=f"{workdir}/stimuli/kim22-coord-unique.csv",
+    )
+
+
+def fresh():
+    """drops the template caches, so that every run tokenizes like a new one."""
+    templating.chat_scaffold.cache_clear()
+    templating.encoder.cache_clear()
+
+
+def token_count(tokenizer, texts):
+    return sum(len(ids) for ids in tokenizer(list(texts), add_special_tokens=True).input_ids)
+
+
+def prepare(case, workdir, args):
+    """
+    Loads what `case` needs, and returns (run, rows, tokens): `run()` does
+    one pass over the workload, of `rows` rows and `tokens` tokens (None for
+    coalesce, which doesn't tokenize).
+    """
+    model = f"{workdir}/model"
+    options = {
+        "model": model,
+        "device": args.device,
+        "batch_size": args.batch_size,
+        "backend": args.backend,
+    }
+    items = utils.read_csv_dict(f"{workdir}/items.csv")
+
+    if case in ("generate", "rescore"):
+        gen_args = cli.stage_args(
+            "generate",
+            **options,
+            instruct=args.instruct,
+            num_gen=args.num_gen,
+            max_gen=args.max_gen,
+            max_tokens=args.max_tokens,
+        )
+        lm = generate.load_model(model, args.device, args.backend)
+        stimuli = generate.build_stimuli(items, lm.tokenizer, args.instruct)
+
+        if case == "generate":
+            config = next(iter(generate.sweep_grid(gen_args, "freeform")))
+            batches = generate.encode_batches(lm.tokenizer, stimuli, args.batch_size, args.device)
+            outputs = []
+
+            def run():
+                outputs[:] = [
+                    generate.generate_batch(lm, batch, gen_args, None, config)
+                    for batch in batches
+                ]
+
+            run()
+            sentences = [
+                sentence
+                for records in outputs
+                for _, _, d1, d2 in records
+                for sentence, _ in d1 + d2
+            ]
+            tokens = sum(
+                len(ids)
+                for ids in lm.tokenizer(sentences, add_special_tokens=False).input_ids
+            )
+            return run, len(sentences), tokens
+
+        rng = random.Random(args.seed)
+        joined = [
+            [generate.join(prompt, synthetic_continuation(rng)) for _ in range(args.num_gen)]
+            for _, prompt, _ in stimuli
+        ]
+
+        def run():
+            for group in joined:
+                generate.rescore(lm, group, args.max_tokens)
+
+        rows = [row for group in joined for row in group]
+        return run, len(rows), token_count(lm.tokenizer, rows)
+
+    if case in ("eval", "rejection-eval"):
+        mode = "freeform" if case == "eval" else "rejection"
+        entries = utils.read_csv_dict(f"{workdir}/sorted/{mode}/{NAME}-arc.csv")
+        score_args = cli.stage_args(
+            case,
+            **options,
+            instruct=args.instruct,
+            share_prefix=args.share_prefix,
+            max_tokens=args.max_tokens,
+            gather_logprobs=args.gather_logprobs,
+            logprob_chunk=args.logprob_chunk,
+        )
+        lm = scoring.load_model(model, args.device, args.backend)
+
+        def build():
+            if case == "eval":
+                return evaluate.build_stimuli(entries, lm.tokenizer, args.instruct)
+            _, stimuli, prefix_keys = rejection.build_stimuli(
+                entries, lm.tokenizer, score_args.headers, args.instruct
+            )
+            return stimuli, prefix_keys
+
+        def run():
+            stimuli, prefix_keys = build()
+            scoring.score_stimuli(lm, stimuli, prefix_keys, score_args)
+
+        stimuli, _ = build()
+        return run, len(stimuli), token_count(lm.tokenizer, stimuli)
+
+    coalesce_args = cli.stage_args(
+        "coalesce",
+        generations_dir=f"{workdir}/generations",
+        outdir=tempfile.mkdtemp(dir=workdir),
+        arc_stimuli=f"{workdir}/stimuli/kim22-arc-unique.csv",
+        coord_stimuli=f"{workdir}/stimuli/kim22-coord-unique.csv",
+    )
+    rows = sum(
+        1
+        for path in pathlib.Path(f"{workdir}/generations/{NAME}").iterdir()
+        for _ in utils.read_generations(path)
+    )
+
+    def run():
+        coalesce.coalesce_model(f"{workdir}/generations/{NAME}", coalesce_args)
+
+    return run, rows, None
+
+
+def run_case(case, workdir, args):
+    """Times `case` in this process, and returns its metrics."""
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    run, rows, tokens = prepare(case, workdir, args)
+    for _ in range(args.warmup):
+        fresh()
+        run()
+
+    seconds = []
+    for _ in range(args.repeats):
+        fresh()
+        with parallel.Timer() as timer:
+            run()
+        seconds.append(timer.seconds)
+
+    median = float(np.median(seconds))
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99]).tolist()
+    return {
+        "rows": rows,
+        "tokens": tokens,
+        "rows_per_second": round(rows / median, 3),
+        "tokens_per_second": round(tokens / median, 3) if tokens is not None else None,
+        "latency_p50": round(p50, 4),
+        "latency_p90": round(p90, 4),
+        "latency_p99": round(p99, 4),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "threads": torch.get_num_threads(),
+    }
+
+
+def workload(args):
+    return {name: value for name, value in sorted(vars(args).items()) if name not in RUN_OPTIONS}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, history, threshold):
+    """
+    messages for the cases of `results` that regressed from the last run in
+    `history` that has them.
+    """
+    messages = []
+    for case, metrics in results.items():
+        runs = [run for run in history if case in run["cases"]]
+        if not runs:
+            continue
+        baseline = runs[-1]
+        known = baseline["cases"][case]
+        if metrics["rows_per_second"] < (1 - threshold) * known["rows_per_second"]:
+            messages.append(
+                f"{case}: {metrics['rows_per_second']} rows/s, down from "
+                f"{known['rows_per_second']} ({baseline['time']})"
+            )
+        if metrics["peak_rss_mb"] > (1 + threshold) * known["peak_rss_mb"]:
+            messages.append(
+                f"{case}: peak RSS {metrics['peak_rss_mb']} MB, up from "
+                f"{known['peak_rss_mb']} MB ({baseline['time']})"
+            )
+    return messages
+
+
+def report(results):
+    print(
+        f"{'case':<16}{'rows':>8}{'rows/s':>12}{'tokens/s':>12}"
+        f"{'p50 s':>10}{'p90 s':>10}{'p99 s':>10}{'RSS MB':>10}"
+    )
+    for case, m in results.items():
+        tokens_per_second = "-" if m["tokens_per_second"] is None else m["tokens_per_second"]
+        print(
+            f"{case:<16}{m['rows']:>8}{m['rows_per_second']:>12}{tokens_per_second:>12}"
+            f"{m['latency_p50']:>10}{m['latency_p90']:>10}{m['latency_p99']:>10}"
+            f"{m['peak_rss_mb']:>10}"
+        )
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        setup(workdir, args)
+
+        results = {}
+        context = multiprocessing.get_context("spawn")
+        for case in args.cases:
+            print(f"bench: {case}")
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results[case] = executor.submit(run_case, case, workdir, args).result()
+
+    report(results)
+
+    if args.history is None:
+        return
+
+    history = utils.read_json(args.history) if os.path.exists(args.history) else []
+    run = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "host": platform.node(),
+        "workload": workload(args),
+        "cases": results,
+    }
+    matching = [
+        past
+        for past in history
+        if past["host"] == run["host"] and past["workload"] == run["workload"]
+    ]
+    failed = regressions(results, matching, args.threshold)
+    for message in failed:
+        print(f"regression: {message}")
+
+    if not failed or args.accept:
+        history.append(run)
+        pathlib.Path(args.history).parent.mkdir(exist_ok=True, parents=True)
+        with checkpoint.atomic_path(args.history) as tmp:
+            utils.write_json(history, tmp)
+
+    if failed and not args.accept:
+        raise RuntimeError(
+            f"{len(failed)} regression(s) past {args.threshold:.0%}; "
+            "not recorded (rerun with --accept to record it as the new baseline)"
+        )
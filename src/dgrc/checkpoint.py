@@ -0,0 +1,116 @@
+"""
+Checkpointing for long generation/scoring runs.
+
+Finished units of work (a generation batch, a chunk of scored rows) are
+written as append-only shard files in a checkpoint directory, alongside a
+manifest listing the finished shards and the run parameters. Every file is
+written to a temporary path first and then moved into place, so a crash can
+never leave a half-written shard or manifest behind. With `resume=True`,
+finished keys are skipped, and the final output is assembled from the shards
+in key order, so it is identical to that of an uninterrupted run.
+"""
+
+import json
+import os
+import pathlib
+import shutil
+
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    yields a temporary path to write to, which replaces `path` once the
+    block finishes without errors.
+    """
+    tmp = f"{path}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class Checkpoint:
+    def __init__(self, directory, meta=None, resume=False):
+        """
+        directory: where shards and the manifest are kept.
+        meta: run parameters; resuming a checkpoint made with different
+            parameters raises an error.
+        resume: if False, any existing checkpoint in `directory` is discarded.
+        """
+        self.directory = pathlib.Path(directory)
+        self.manifest_path = self.directory / "manifest.json"
+        self.meta = meta or {}
+
+        if not resume and self.directory.exists():
+            shutil.rmtree(self.directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest["meta"] != json.loads(json.dumps(self.meta)):
+                raise ValueError(
+                    f"Checkpoint in {self.directory} was made with different parameters: "
+                    f"{self.manifest['meta']}"
+                )
+            print(f"Resuming from {self.directory}: {len(self.manifest['shards'])} shards done")
+        else:
+            self.manifest = {"meta": self.meta, "shards": []}
+            self._write_manifest()
+
+    def _write_manifest(self):
+        with atomic_path(self.manifest_path) as tmp:
+            with open(tmp, "w") as f:
+                json.dump(self.manifest, f)
+
+    def done(self):
+        return {shard["key"] for shard in self.manifest["shards"]}
+
+    def write(self, key, records):
+        """stores the records of one finished unit of work under `key` (an int)."""
+        name = f"shard-{len(self.manifest['shards']):05d}.json"
+        with atomic_path(self.directory / name) as tmp:
+            with open(tmp, "w") as f:
+                json.dump(records, f)
+
+        self.manifest["shards"].append({"key": key, "file": name})
+        self._write_manifest()
+
+    def record(self, key):
+        """the records of the shard stored under `key`."""
+        for shard in self.manifest["shards"]:
+            if shard["key"] == key:
+                with open(self.directory / shard["file"]) as f:
+                    return json.load(f)
+        raise KeyError(key)
+
+    def records(self):
+        """yields the records of every shard, in key order."""
+        for shard in sorted(self.manifest["shards"], key=lambda s: s["key"]):
+            with open(self.directory / shard["file"]) as f:
+                yield json.load(f)
+
+    def remove(self):
+        shutil.rmtree(self.directory)
+        # also drop the parent checkpoints/ directory once it's empty
+        if not any(self.directory.parent.iterdir()):
+            self.directory.parent.rmdir()
+
+
+def checkpointed_score(checkpoint, n, score_fn, chunk_size=1024):
+    """
+    Scores rows 0..n-1 in chunks of `chunk_size`, skipping chunks that are
+    already in `checkpoint`. `score_fn(indices)` returns the scores for the
+    given row positions. Returns all scores, in order.
+    """
+    done = checkpoint.done()
+    for start in range(0, n, chunk_size):
+        if start in done:
+            continue
+        checkpoint.write(start, score_fn(list(range(start, min(start + chunk_size, n)))))
+
+    return [score for chunk in checkpoint.records() for score in chunk]
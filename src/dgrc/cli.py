@@ -0,0 +1,400 @@
+"""
+The `dgrc` command line: one subcommand per stage of the pipeline.
+
+    python -m dgrc stimuli          # Step 0: prepare data
+    python -m dgrc generate ...     # Steps 1-2: divide and generate
+    python -m dgrc coalesce ...     # Step 3: recombine
+    python -m dgrc eval ...         # Step 4: DGRC evaluation
+    python -m dgrc rejection-eval   # Step 4: rejection evaluation
+    python -m dgrc stream ...       # Steps 1-4 for one model, in one pass
+    python -m dgrc pipeline ...     # all of the above, rebuilding stale outputs
+    python -m dgrc bench ...        # offline benchmarks of the hot paths
+    python -m dgrc accuracy ...     # scores of the faster backends vs fp32
+
+Only argparse is imported up front; a stage's module (and with it torch,
+transformers and minicons, for the model stages) is imported when the stage
+runs, so `--help` and the data-only stages start without loading them.
+
+`run(stage, **options)` runs a stage in-process, with the same defaults and
+checks as the command line, e.g. `run("eval", model=..., mode="coord")`.
+"""
+
+import argparse
+import importlib
+
+from dgrc.headers import HEYWAIT_HEADER, NO_HEADER
+
+# stage -> (module, function called with the parsed arguments)
+STAGES = {
+    "stimuli": ("dgrc.stimuli", "main"),
+    "generate": ("dgrc.generate", "run"),
+    "coalesce": ("dgrc.coalesce", "main"),
+    "eval": ("dgrc.evaluate", "main"),
+    "rejection-eval": ("dgrc.rejection", "main"),
+    "stream": ("dgrc.stream", "main"),
+    "pipeline": ("dgrc.pipeline", "main"),
+    "bench": ("dgrc.bench", "main"),
+    "accuracy": ("dgrc.accuracy", "main"),
+}
+
+# `dgrc.backends.BACKENDS`, without importing torch
+BACKENDS = ["fp32", "bf16", "int8", "compile"]
+
+
+def add_stimuli_args(parser):
+    parser.add_argument("--analysis_data", type=str, default="data/kim22_used_items.csv")
+    parser.add_argument("--outdir", type=str, default="data/stimuli")
+
+
+def add_generate_args(parser):
+    parser.add_argument(
+        "--model", type=str, default="HuggingFaceTB/SmolLM2-360M-Instruct"
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_gen", type=int, default=10)
+    parser.add_argument("--max_gen", type=int, default=20)
+    parser.add_argument("--topp", "-p", type=float, default=None)
+    parser.add_argument("--topk", "-k", type=int, default=0)
+    parser.add_argument("--temp", "-t", type=float, default=1.0)
+    parser.add_argument("--instruct", action="store_true")
+    parser.add_argument("--response", type=str, default=None)
+    parser.add_argument("--outdir", type=str, default="data/generations/smolm2-360m")
+    parser.add_argument("--outfile", type=str, default="gens_0_0_1-0.jsonl")
+    parser.add_argument("--analysis_data", type=str, default="data/kim22_used_items.csv")
+    parser.add_argument(
+        "--score_from_generate",
+        action="store_true",
+        help="score the sampled tokens from the generate logits instead of rescoring "
+        "the joined strings; this changes the stored scores (by 1e-2 or more) and "
+        "so which continuations coalesce keeps",
+    )
+    parser.add_argument(
+        "--verify_scores",
+        action="store_true",
+        help="with --score_from_generate, also rescore as by default and report the "
+        "gap and how many items rank their samples differently",
+    )
+    parser.add_argument("--score_tolerance", type=float, default=1e-3)
+    parser.add_argument("--sweep", action="store_true")
+    parser.add_argument("--sweep_topp", nargs="+", default=["-1", "0", "0.9", "0.95"])
+    parser.add_argument("--sweep_topk", nargs="+", default=["50", "0"])
+    parser.add_argument("--sweep_temp", nargs="+", default=["0.7", "1.0"])
+    parser.add_argument(
+        "--sweep_modes", nargs="+", default=["rejection", "freeform"]
+    )
+    parser.add_argument("--pack_configs", action="store_true")
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--checkpoint", action="store_true")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--seeded_streams", action="store_true")
+    parser.add_argument("--seed", type=int, default=1024)
+    parser.add_argument("--early_stop", action="store_true")
+    parser.add_argument("--stop_strings", nargs="*", default=None)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument("--round_size", type=int, default=5)
+    parser.add_argument("--top_k_stable", type=int, default=10)
+    parser.add_argument("--patience", type=int, default=2)
+    parser.add_argument("--max_duplicate_rate", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--throughput_report", type=str, default=None)
+    add_backend_args(parser)
+    add_autobatch_args(parser)
+    add_instrument_args(parser)
+
+
+def add_logprob_args(parser):
+    parser.add_argument("--gather_logprobs", action="store_true")
+    parser.add_argument("--logprob_chunk", type=int, default=256)
+
+
+def add_backend_args(parser):
+    parser.add_argument("--backend", type=str, default="fp32", choices=BACKENDS)
+
+
+def add_autobatch_args(parser):
+    parser.add_argument("--auto_batch", action="store_true")
+    parser.add_argument("--batch_memory", type=float, default=0.5)
+    parser.add_argument("--batch_sizes", type=str, default="data/results/batch-sizes.json")
+
+
+def add_instrument_args(parser):
+    parser.add_argument("--profile_batches", nargs="*", type=int, default=None)
+    parser.add_argument("--profile_dir", type=str, default="profiles")
+
+
+def add_coalesce_args(parser):
+    parser.add_argument("--generations_dir", type=str, default="data/results/generations")
+    parser.add_argument("--outdir", type=str, default="data/results/sorted-generations")
+    parser.add_argument("--arc_stimuli", type=str, default="data/stimuli/kim22-arc-unique.csv")
+    parser.add_argument("--coord_stimuli", type=str, default="data/stimuli/kim22-coord-unique.csv")
+    parser.add_argument("--models", nargs="+", default=None)
+    parser.add_argument("--sample", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=1)
+
+
+def add_scoring_args(parser):
+    """Arguments shared by `eval` and `rejection-eval`."""
+    parser.add_argument(
+        "--model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct"
+    )
+    parser.add_argument("--mode", type=str, default="arc")
+    parser.add_argument("--sorted_dir", type=str, default="data/results/sorted-generations")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--instruct", action="store_true")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--share_prefix", action="store_true")
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--score_cache", type=str, default=None)
+    parser.add_argument("--checkpoint", action="store_true")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--checkpoint_every", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--throughput_report", type=str, default=None)
+    parser.add_argument("--token_store", type=str, default=None)
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--verify_templates", action="store_true")
+    add_logprob_args(parser)
+    add_backend_args(parser)
+    add_autobatch_args(parser)
+    add_instrument_args(parser)
+
+
+def add_eval_args(parser):
+    parser.add_argument("--results-dir", type=str, default="data/results/dgrc/freeform-arc")
+    add_scoring_args(parser)
+
+
+def add_rejection_eval_args(parser):
+    parser.add_argument(
+        "--results-dir", type=str, default="data/results/dgrc/rejection-arc"
+    )
+    parser.add_argument("--headers", nargs="+", default=[NO_HEADER, HEYWAIT_HEADER])
+    parser.add_argument("--kim22_headers", action="store_true")
+    add_scoring_args(parser)
+
+
+def add_stream_args(parser):
+    add_generate_args(parser)
+    parser.add_argument("--arc_stimuli", type=str, default="data/stimuli/kim22-arc-unique.csv")
+    parser.add_argument("--coord_stimuli", type=str, default="data/stimuli/kim22-coord-unique.csv")
+    parser.add_argument("--conditions", nargs="+", default=["arc", "coord"])
+    parser.add_argument("--sample", type=int, default=10)
+    parser.add_argument("--results_dir", type=str, default="data/results/dgrc")
+    parser.add_argument("--sorted_dir", type=str, default=None)
+    parser.add_argument("--write_generations", action="store_true")
+    parser.add_argument("--headers", nargs="+", default=[NO_HEADER, HEYWAIT_HEADER])
+    parser.add_argument("--kim22_headers", action="store_true")
+    parser.add_argument("--share_prefix", action="store_true")
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--verify_templates", action="store_true")
+    add_logprob_args(parser)
+    parser.add_argument("--queue_size", type=int, default=2)
+
+
+def add_pipeline_args(parser):
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--models", nargs="+", default=None)
+    parser.add_argument("--conditions", nargs="+", default=["arc", "coord"])
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        default=["eval", "rejection-eval"],
+        choices=["stimuli", "generate", "coalesce", "eval", "rejection-eval"],
+    )
+    parser.add_argument("--devices", nargs="+", default=["cpu"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--auto_batch", action="store_true")
+    add_backend_args(parser)
+    add_logprob_args(parser)
+    parser.add_argument("--score_cache", type=str, default=None)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--dry_run", action="store_true")
+
+
+def add_bench_args(parser):
+    parser.add_argument(
+        "--cases",
+        nargs="+",
+        default=["generate", "rescore", "eval", "rejection-eval", "coalesce"],
+        choices=["generate", "rescore", "eval", "rejection-eval", "coalesce"],
+    )
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--instruct", action="store_true")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_gen", type=int, default=10)
+    parser.add_argument("--max_gen", type=int, default=20)
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--share_prefix", action="store_true")
+    add_backend_args(parser)
+    add_logprob_args(parser)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--vocab_size", type=int, default=2000)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--workdir", type=str, default=None)
+    parser.add_argument("--history", type=str, default="data/results/bench-history.json")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--accept", action="store_true")
+
+
+def add_accuracy_args(parser):
+    parser.add_argument(
+        "--model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct"
+    )
+    parser.add_argument("--instruct", action="store_true")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--backends", nargs="+", default=BACKENDS[1:], choices=BACKENDS[1:]
+    )
+    parser.add_argument(
+        "--modes", nargs="+", default=["freeform", "rejection"], choices=["freeform", "rejection"]
+    )
+    parser.add_argument("--conditions", nargs="+", default=["arc", "coord"])
+    parser.add_argument("--sorted_dir", type=str, default="data/results/sorted-generations")
+    parser.add_argument("--headers", nargs="+", default=[NO_HEADER, HEYWAIT_HEADER])
+    parser.add_argument("--kim22_headers", action="store_true")
+    parser.add_argument("--items", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--share_prefix", action="store_true")
+    parser.add_argument("--warmup", action="store_true")
+    parser.add_argument("--output", type=str, default=None)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="dgrc")
+    subparsers = parser.add_subparsers(dest="stage", metavar="stage", required=True)
+
+    for stage, add_args, help in [
+        ("stimuli", add_stimuli_args, "Step 0: split the Kim et al. (2022) items into stimuli"),
+        ("generate", add_generate_args, "Steps 1-2: collect generations from a model"),
+        ("coalesce", add_coalesce_args, "Step 3: join the top generations with the stimuli"),
+        ("eval", add_eval_args, "Step 4: score the recombined dialogues"),
+        ("rejection-eval", add_rejection_eval_args, "Step 4: score them after rejection headers"),
+        ("stream", add_stream_args, "Steps 1-4: generate, recombine and score in one pass"),
+        ("pipeline", add_pipeline_args, "Steps 0-4: rebuild the outputs that are out of date"),
+        ("bench", add_bench_args, "Offline benchmarks of the hot paths, on a small random model"),
+        ("accuracy", add_accuracy_args, "Scores of the faster --backend modes against fp32"),
+    ]:
+        add_args(subparsers.add_parser(stage, help=help))
+
+    return parser
+
+
+def check(args):
+    """
+    Fills in the options implied by others, and returns an error message for
+    combinations a stage can't run with (None if there are none).
+    """
+    if args.stage in ("generate", "stream") and args.adaptive:
+        # rounds continue each prompt's own random streams
+        args.seeded_streams = True
+
+    if args.stage in ("eval", "rejection-eval") and args.token_store is not None and (
+        args.workers > 1
+        or args.score_cache is not None
+        or args.checkpoint
+        or args.resume
+        or args.share_prefix
+        or args.dedup
+    ):
+        return (
+            "--token_store scores every row in a single pass, and can't be combined "
+            "with --workers, --score_cache, --checkpoint/--resume, --share_prefix "
+            "or --dedup"
+        )
+
+    if args.stage == "stream" and (
+        args.workers > 1
+        or args.checkpoint
+        or args.resume
+        or args.pack_configs
+        or args.auto_batch
+    ):
+        return (
+            "stream runs on one copy of the model and keeps its results in memory, "
+            "and can't be combined with --workers, --checkpoint/--resume, "
+            "--pack_configs or --auto_batch"
+        )
+
+    if args.stage in ("generate", "eval", "rejection-eval") and (
+        args.auto_batch and args.workers > 1
+    ):
+        return (
+            "--auto_batch sizes the batches of one copy of the model, and can't be "
+            "combined with --workers"
+        )
+
+    if getattr(args, "gather_logprobs", False) and (
+        getattr(args, "share_prefix", False) or getattr(args, "token_store", None) is not None
+    ):
+        return (
+            "--gather_logprobs scores whole sequences, and can't be combined with "
+            "--share_prefix or --token_store"
+        )
+
+    int8 = getattr(args, "backend", None) == "int8" or "int8" in getattr(args, "backends", ())
+    devices = getattr(args, "devices", None) or [getattr(args, "device", "cpu")]
+    if int8 and any(not device.startswith("cpu") for device in devices):
+        return "the int8 backend runs on cpu only"
+
+    if args.stage in ("eval", "rejection-eval", "pipeline") and (
+        args.auto_batch and args.max_tokens is not None
+    ):
+        return (
+            "--auto_batch picks the token budget of the scoring batches, and can't be "
+            "combined with --max_tokens"
+        )
+
+    return None
+
+
+def dispatch(args):
+    module, function = STAGES[args.stage]
+    return getattr(importlib.import_module(module), function)(args)
+
+
+def stage_args(stage, **options):
+    """
+    The arguments `stage` runs with: `options` are the stage's command line
+    options by their argparse dest (e.g. `results_dir` for --results-dir),
+    and the rest keep their command line defaults.
+    """
+    if stage not in STAGES:
+        raise ValueError(f"unknown stage {stage!r}, expected one of {list(STAGES)}")
+
+    args = build_parser().parse_args([stage])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError(f"{stage} has no option {name!r}")
+        setattr(args, name, value)
+
+    error = check(args)
+    if error is not None:
+        raise ValueError(error)
+
+    return args
+
+
+def run(stage, **options):
+    """Runs `stage` in-process, with `options` as in `stage_args`."""
+    return dispatch(stage_args(stage, **options))
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    error = check(args)
+    if error is not None:
+        parser.error(error)
+
+    dispatch(args)
@@ -0,0 +1,202 @@
+"""
+Step 3 (Recombine): collects the generations of every model under
+--generations_dir, keeps the top --sample unique continuations (by logprob)
+per (item, vp type), and joins them with the ARC and COORD stimuli, writing
+{outdir}/{freeform,rejection}/{model}-{arc,coord}.csv.
+
+Generations are kept as columns (numpy arrays of item, vp type, sentence id
+and logprob) and deduplicated, ranked and joined with array operations;
+output rows are streamed to the csv. Model directories are processed in
+parallel with --workers.
+"""
+
+import csv
+import os
+import pathlib
+
+import numpy as np
+
+from dgrc import instrument, utils
+from concurrent.futures import ProcessPoolExecutor
+
+VP_TYPES = ["vp1", "vp2"]
+MODES = ["freeform", "rejection"]
+CONDITIONS = ["arc", "coord"]
+
+
+class Generations:
+    """
+    Columnar store of generated samples: sentences are interned as ids, so
+    that everything else is a numeric column.
+    """
+
+    def __init__(self):
+        self.sentence_ids = {}
+        self.sentences = []
+        self.vp, self.idx, self.sid, self.logprob = [], [], [], []
+
+    def add(self, idx, vp, sentence, logprob):
+        sid = self.sentence_ids.get(sentence)
+        if sid is None:
+            sid = self.sentence_ids[sentence] = len(self.sentences)
+            self.sentences.append(sentence)
+        self.vp.append(VP_TYPES.index(vp))
+        self.idx.append(idx)
+        self.sid.append(sid)
+        self.logprob.append(logprob)
+
+    @instrument.timed("read")
+    def add_file(self, path):
+        for record in utils.read_generations(path):
+            self.add(record["idx"], record["vp"], record["sentence"], record["logprob"])
+
+    @instrument.timed("rank")
+    def top(self, sample=10):
+        """
+        Unique (sentence, logprob) pairs per (vp type, item), sorted by vp
+        type, item and descending logprob, keeping the first `sample` of each.
+        Returns (vp, idx, sid, rank) arrays, rank starting at 1.
+        """
+        vp = np.asarray(self.vp, dtype=np.int64)
+        idx = np.asarray(self.idx, dtype=np.int64)
+        sid = np.asarray(self.sid, dtype=np.int64)
+        logprob = np.asarray(self.logprob, dtype=np.float64)
+
+        order = np.lexsort((sid, -logprob, idx, vp))
+        vp, idx, sid, logprob = vp[order], idx[order], sid[order], logprob[order]
+
+        # drop exact duplicates, which are now adjacent
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (
+            (vp[1:] != vp[:-1])
+            | (idx[1:] != idx[:-1])
+            | (sid[1:] != sid[:-1])
+            | (logprob[1:] != logprob[:-1])
+        )
+        vp, idx, sid = vp[keep], idx[keep], sid[keep]
+
+        # rank within each (vp type, item) group
+        starts = np.ones(len(vp), dtype=bool)
+        starts[1:] = (vp[1:] != vp[:-1]) | (idx[1:] != idx[:-1])
+        group_start = np.maximum.accumulate(np.where(starts, np.arange(len(vp)), 0))
+        rank = np.arange(len(vp)) - group_start + 1
+
+        keep = rank <= sample
+        return vp[keep], idx[keep], sid[keep], rank[keep]
+
+
+def read_stimuli(path):
+    """(header, rows, item column) of a stimuli csv."""
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    items = np.array([int(row[header.index("item")]) for row in rows], dtype=np.int64)
+    return header, rows, items
+
+
+def join(stimuli, idx):
+    """
+    Pairs every continuation (by its item, `idx`) with each stimulus row of the
+    same item, in order. Returns (continuation positions, stimulus rows).
+    """
+    _, _, items = stimuli
+    by_item = np.argsort(items, kind="stable")
+    sorted_items = items[by_item]
+
+    starts = np.searchsorted(sorted_items, idx, side="left")
+    counts = np.searchsorted(sorted_items, idx, side="right") - starts
+
+    continuations = np.repeat(np.arange(len(idx)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return continuations, by_item[np.repeat(starts, counts) + offsets]
+
+
+def joined_rows(stimuli, generations, top):
+    """
+    The rows of a sorted-generation csv: every stimulus row followed by
+    (continuation_type, continuation_id, continuation), in the order of `top`.
+    """
+    _, rows, _ = stimuli
+    vp, idx, sid, rank = top
+    continuations, stimulus_rows = join(stimuli, idx)
+
+    vp_names = [VP_TYPES[v] for v in vp.tolist()]
+    ranks = rank.tolist()
+    texts = [generations.sentences[s].strip() for s in sid.tolist()]
+
+    for c, r in zip(continuations.tolist(), stimulus_rows.tolist()):
+        yield rows[r] + [vp_names[c], ranks[c], texts[c]]
+
+
+def joined_header(stimuli):
+    header, _, _ = stimuli
+    return header + ["continuation_type", "continuation_id", "continuation"]
+
+
+@instrument.timed("write")
+def write_joined(path, stimuli, generations, top):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(joined_header(stimuli))
+        n = 0
+        for row in joined_rows(stimuli, generations, top):
+            writer.writerow(row)
+            n += 1
+
+    return n
+
+
+def coalesce_model(model_dir, args):
+    """writes the sorted-generation csvs of one model directory."""
+    name = pathlib.Path(model_dir).name
+    instrument.start(label=name)
+    stimuli = {
+        condition: read_stimuli(getattr(args, f"{condition}_stimuli"))
+        for condition in CONDITIONS
+    }
+
+    generations = {mode: Generations() for mode in MODES}
+    for file in os.listdir(model_dir):
+        # (skipping the perf reports written next to the generations)
+        if "json" in file and not file.endswith(".perf.json"):
+            for mode in MODES:
+                if mode in file:
+                    generations[mode].add_file(f"{model_dir}/{file}")
+                    break
+
+    outputs = []
+    for mode in MODES:
+        save_path = f"{args.outdir}/{mode}"
+        pathlib.Path(save_path).mkdir(exist_ok=True, parents=True)
+
+        top = generations[mode].top(args.sample)
+        for condition in CONDITIONS:
+            outputs.append(f"{save_path}/{name}-{condition}.csv")
+            n = write_joined(
+                outputs[-1],
+                stimuli[condition],
+                generations[mode],
+                top,
+            )
+            if condition == "arc":
+                print(f"Model: {name}. Len: {n}")
+
+    instrument.write_report(outputs, stage="coalesce-generations", model=name)
+    instrument.stop()
+    return name
+
+
+def main(args):
+    model_dirs = [
+        f"{args.generations_dir}/{d}"
+        for d in sorted(os.listdir(args.generations_dir))
+        if args.models is None or d in args.models
+    ]
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(coalesce_model, model_dirs, [args] * len(model_dirs)))
+    else:
+        for model_dir in model_dirs:
+            coalesce_model(model_dir, args)
@@ -0,0 +1,219 @@
+"""
+Step 4 (compare): the body that `eval` and `rejection-eval` share. The model
+is loaded (or --workers are started), the sorted generations are read and
+turned into stimuli, the stimuli are scored (through --score_cache, --dedup,
+--token_store or --checkpoint/--resume, and --auto_batch), and the scores are
+written to {results_dir}/{model}.csv.
+
+The two stages only differ in the stimuli they build from the rows and in
+the columns written before the scores, which they pass in as `build`.
+"""
+
+import functools
+import pathlib
+import torch
+
+from dgrc import (
+    autobatch,
+    checkpoint,
+    instrument,
+    models,
+    parallel,
+    score_cache,
+    scoring,
+    templating,
+    token_store,
+    utils,
+)
+from transformers import AutoConfig, AutoTokenizer
+
+
+def main(args, stage, setting, build):
+    """
+    Scores {sorted_dir}/{setting}/{model}-{mode}.csv as `stage` ("eval" or
+    "rejection-eval"). `build(entries, tokenizer)` returns the stimuli, the
+    keys of the prefixes they share, the columns written before the scores
+    ({name: values}, one value per stimulus), and anything else the
+    checkpoint is keyed on ({name: value}).
+    """
+    model = args.model
+    instruct = args.instruct
+    mode = args.mode
+    label = f"dgrc-{stage}"
+
+    # load the model, or start the workers that each load their own copy
+    pool = None
+    if args.workers > 1:
+        pool = parallel.WorkerPool(
+            functools.partial(scoring.load_model, model, args.device, args.backend),
+            args.workers,
+            args.threads,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model, trust_remote_code=True)
+        model_config = AutoConfig.from_pretrained(model, trust_remote_code=True)
+    else:
+        lm = scoring.load_model(model, args.device, args.backend)
+        tokenizer = lm.tokenizer
+        model_config = lm.model.config
+        if args.auto_batch:
+            # score with the token budget that fits in memory
+            args.max_tokens = autobatch.start(
+                model,
+                stage,
+                lm.model,
+                args.device,
+                args.batch_sizes,
+                args.batch_memory,
+                gather=args.gather_logprobs,
+            ).max_tokens
+
+    instrument.start(
+        lm.model if pool is None else None,
+        args.profile_batches,
+        args.profile_dir,
+        label=f"{models.savename(model)}-{mode}",
+    )
+
+    eval_file = models.savename(model)
+    eval_path = f"{args.sorted_dir}/{setting}/{eval_file}-{mode}.csv"
+    eval = utils.read_csv_dict(eval_path)
+
+    stimuli, prefix_keys, columns, meta = build(eval, tokenizer)
+
+    def score_rows(rows):
+        if pool is None:
+            return scoring.score_stimuli(
+                lm,
+                [stimuli[i] for i in rows],
+                [prefix_keys[i] for i in rows],
+                args,
+            )
+        # split the rows across workers, in batch-aligned contiguous shards
+        shards = parallel.shard(rows, args.workers, multiple=args.batch_size)
+        shards = [
+            ([stimuli[i] for i in shard], [prefix_keys[i] for i in shard])
+            for shard in shards
+        ]
+        return [
+            score
+            for shard_scores in pool.map(
+                functools.partial(scoring.score_shard, args=args), shards
+            )
+            for score in shard_scores
+        ]
+
+    cache = None
+    if args.score_cache is not None:
+        # only score the stimuli that aren't in the cache yet
+        cache = score_cache.ScoreCache(
+            args.score_cache,
+            model,
+            score_cache.model_revision(model, model_config),
+            args.backend,
+        )
+        uncached_score_rows = score_rows
+
+        def score_rows(rows):
+            return score_cache.cached_score(
+                cache,
+                [stimuli[i] for i in rows],
+                lambda subset: uncached_score_rows([rows[i] for i in subset]),
+                bow_correction=True,
+            )
+
+    rows = list(range(len(stimuli)))
+    if args.dedup:
+        # score every distinct stimulus once, and copy its score to its duplicates
+        rows, inverse = scoring.unique_rows(stimuli)
+        print(
+            f"Dedup: {len(rows)}/{len(stimuli)} unique stimuli "
+            f"({1 - len(rows) / max(len(stimuli), 1):.1%} duplicates)"
+        )
+
+    with parallel.Timer() as timer:
+        if args.token_store is not None:
+            # also keep the per-token log-probs of every row, for re-analysis
+            ckpt = None
+            writer = token_store.TokenStoreWriter(
+                args.token_store,
+                meta={
+                    "model": model,
+                    "revision": score_cache.model_revision(model, model_config),
+                    "eval_path": eval_path,
+                    "instruct": instruct,
+                    "bow": lm.is_bow_tokenizer,
+                    "backend": args.backend,
+                },
+            )
+            if args.verify_templates:
+                templating.verify(lm.tokenizer)
+            scores = token_store.score_to_store(
+                lm,
+                stimuli,
+                writer,
+                batch_size=args.batch_size,
+                max_tokens=args.max_tokens,
+                bow_correction=True,
+            )
+            writer.close()
+            if args.verify_templates:
+                templating.report(lm.tokenizer)
+        elif args.checkpoint or args.resume:
+            # score in chunks, saving each one as a shard as soon as it's done
+            ckpt = checkpoint.Checkpoint(
+                f"{args.results_dir}/checkpoints/{models.savename(model)}",
+                meta={
+                    "model": model,
+                    "eval_path": eval_path,
+                    "rows": len(rows),
+                    "instruct": instruct,
+                    "batch_size": args.batch_size,
+                    "max_tokens": args.max_tokens,
+                    "share_prefix": args.share_prefix,
+                    "backend": args.backend,
+                    "dedup": args.dedup,
+                    **meta,
+                },
+                resume=args.resume,
+            )
+            scores = checkpoint.checkpointed_score(
+                ckpt,
+                len(rows),
+                lambda chunk: score_rows([rows[i] for i in chunk]),
+                args.checkpoint_every,
+            )
+        else:
+            ckpt = None
+            scores = score_rows(rows)
+
+        if args.dedup:
+            scores = [scores[j] for j in inverse]
+
+    if pool is not None:
+        pool.close()
+    parallel.report_throughput(
+        label,
+        args.workers,
+        pool.threads if pool is not None else torch.get_num_threads(),
+        len(stimuli),
+        timer.seconds,
+        args.throughput_report,
+    )
+
+    if cache is not None:
+        cache.close()
+
+    pathlib.Path(args.results_dir).mkdir(exist_ok=True, parents=True)
+
+    scores = list(zip(*columns.values(), scores))
+
+    output = f"{args.results_dir}/{models.savename(model)}.csv"
+    with instrument.stage("write"), checkpoint.atomic_path(output) as tmp:
+        utils.write_csv(data=scores, path=tmp, header=[*columns, "score"])
+
+    instrument.write_report([output], stage=label)
+    instrument.stop()
+    autobatch.stop()
+
+    if ckpt is not None:
+        ckpt.remove()
@@ -0,0 +1,162 @@
+"""
+A sampling loop that retires finished rows from the batch, for
+`dgrc generate --early_stop`.
+
+`generate` keeps decoding every row until all of them are done (or until
+`max_new_tokens`), padding the rows that already finished. Here, a row stops
+as soon as it samples an end-of-turn token, or as soon as its decoded text
+contains one of the stop strings (e.g. the closing quote of the dialog
+template, or sentence-final punctuation), and is dropped from the batch and
+from the kv-cache, so later steps only run on the rows that are still going.
+
+Sampling follows `generate(do_sample=True, repetition_penalty=...)`: the
+repetition penalty, then temperature/top-k/top-p (per row, see
+`sampling.PerRowSamplingWarper`), then a multinomial draw, or the row's own
+random stream with `seeds`. The output has the same layout as `generate`'s:
+finished rows are padded with the pad token.
+"""
+
+import torch
+
+from dgrc import sampling
+from types import SimpleNamespace
+from transformers import RepetitionPenaltyLogitsProcessor
+
+
+def stop_token_ids(lm):
+    """end-of-turn ids: the tokenizer's eos plus the model's eos ids (e.g. <|im_end|>)."""
+    ids = set()
+    eos = lm.model.generation_config.eos_token_id
+    if eos is not None:
+        ids.update(eos if isinstance(eos, list) else [eos])
+    if lm.tokenizer.eos_token_id is not None:
+        ids.add(lm.tokenizer.eos_token_id)
+    return sorted(ids)
+
+
+def generate_until_stop(
+    lm,
+    encoded,
+    top_p,
+    top_k,
+    temperature,
+    num_gen=10,
+    max_new=20,
+    stop_strings=(),
+    seeds=None,
+    repetition_penalty=1.2,
+    output_logits=False,
+    sample_offset=0,
+):
+    """
+    encoded: the left-padded prompt batch.
+    top_p, top_k, temperature: one value per prompt.
+    seeds: optional, one per prompt (see `sampling.PerRowSeededSampler`);
+        sample numbers start at `sample_offset`.
+
+    Returns the sequences, (batch * num_gen, prompt + steps), like `generate`.
+    With `output_logits`, returns an object with `.sequences` and `.logits`
+    (the raw logits of every step; rows that were already retired get zeros).
+    """
+    input_ids = encoded["input_ids"].repeat_interleave(num_gen, dim=0)
+    attention_mask = encoded["attention_mask"].repeat_interleave(num_gen, dim=0)
+    rows, prompt_length = input_ids.shape
+    device = input_ids.device
+    pad_token_id = lm.tokenizer.pad_token_id
+
+    if max_new == 0:
+        # nothing to sample: the prompts, like `generate(max_new_tokens=0)`
+        if output_logits:
+            return SimpleNamespace(sequences=input_ids, logits=())
+        return input_ids
+
+    def expand(values):
+        return [v for v in values for _ in range(num_gen)]
+
+    penalty = RepetitionPenaltyLogitsProcessor(repetition_penalty)
+    warper = sampling.PerRowSamplingWarper(
+        top_p=expand(top_p), top_k=expand(top_k), temperature=expand(temperature)
+    )
+    sampler = None
+    if seeds is not None:
+        sampler = sampling.PerRowSeededSampler(
+            [
+                sampling.stream_seed(seed, sample_offset + j)
+                for seed in seeds
+                for j in range(num_gen)
+            ]
+        )
+
+    sequences = torch.full(
+        (rows, prompt_length + max_new), pad_token_id, dtype=input_ids.dtype, device=device
+    )
+    sequences[:, :prompt_length] = input_ids
+    stop_ids = torch.tensor(stop_token_ids(lm), device=device)
+
+    # original row of every row still in the batch
+    active = torch.arange(rows, device=device)
+    step_logits = []
+
+    with torch.no_grad():
+        position_ids = (attention_mask.cumsum(-1) - 1).masked_fill(attention_mask == 0, 1)
+        outputs = lm.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+
+        for step in range(max_new):
+            logits = outputs.logits[:, -1].to(dtype=torch.float32)
+            if output_logits:
+                full = torch.zeros((rows, logits.shape[-1]), device=device)
+                full[active] = logits
+                step_logits.append(full)
+
+            context = sequences[active, : prompt_length + step]
+            scores = warper(context, penalty(context, logits))
+            if sampler is not None:
+                next_tokens = sampler(context, scores).argmax(-1)
+            else:
+                next_tokens = torch.multinomial(scores.softmax(-1), 1).squeeze(1)
+            sequences[active, prompt_length + step] = next_tokens
+
+            finished = torch.isin(next_tokens, stop_ids)
+            if stop_strings:
+                texts = lm.tokenizer.batch_decode(
+                    sequences[active, prompt_length : prompt_length + step + 1],
+                    skip_special_tokens=True,
+                )
+                finished |= torch.tensor(
+                    [any(s in text for s in stop_strings) for text in texts], device=device
+                )
+
+            if finished.all() or step == max_new - 1:
+                break
+
+            if finished.any():
+                # retire finished rows
+                keep = (~finished).nonzero().squeeze(1)
+                active = active[keep]
+                attention_mask = attention_mask[keep]
+                next_tokens = next_tokens[keep]
+                outputs.past_key_values.batch_select_indices(keep)
+                warper.select(keep)
+                if sampler is not None:
+                    sampler.select(keep)
+
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1
+            )
+            outputs = lm.model(
+                input_ids=next_tokens.unsqueeze(-1),
+                attention_mask=attention_mask,
+                position_ids=attention_mask.sum(-1, keepdim=True) - 1,
+                past_key_values=outputs.past_key_values,
+                use_cache=True,
+            )
+
+    sequences = sequences[:, : prompt_length + step + 1]
+    if output_logits:
+        return SimpleNamespace(sequences=sequences, logits=tuple(step_logits))
+    return sequences
@@ -0,0 +1,39 @@
+from dgrc import compare, instrument, templating
+
+
+@instrument.timed("template")
+def build_stimuli(entries, tokenizer, instruct=False):
+    """
+    The scored string of every sorted-generation row (the preamble with the
+    continuation as the reply), and the key of the prefix it shares with the
+    other continuations of the same preamble.
+    """
+    stimuli = []
+    prefix_keys = []
+    for entry in entries:
+        if instruct:
+            stimulus = templating.render_chat(
+                entry["preamble"],
+                tok=tokenizer,
+                response_prompt=entry["continuation"],
+            )
+        else:
+            stimulus = templating.dialog_template(
+                name1=entry["name1"],
+                name2=entry["name2"],
+                preamble=entry["preamble"],
+                response_prompt=entry["continuation"],
+            )
+        stimuli.append(stimulus)
+        prefix_keys.append((entry["name1"], entry["name2"], entry["preamble"]))
+
+    return stimuli, prefix_keys
+
+
+def main(args):
+    def build(entries, tokenizer):
+        stimuli, prefix_keys = build_stimuli(entries, tokenizer, args.instruct)
+        print(stimuli[:2])
+        return stimuli, prefix_keys, {}, {}
+
+    compare.main(args, "eval", "freeform", build)
@@ -0,0 +1,1036 @@
+"""
+Script to collect generations from a model
+
+Allows two types of models:
+1. Instruct-tuned -- this will come with a chat template
+2. Non-instruct tuned -- this will come with a dialogue format
+
+With two settings:
+1. rejection -- with the response starting with "No, that's not true"
+2. freeform -- with only a response prompt, letting the model generated whatever.
+
+Accepts the following generation parameters:
+- Top-k
+- Top-p
+- Temperature
+
+Results are saved as a big json file.
+"""
+
+import functools
+import json
+import pathlib
+import torch
+
+from dgrc import (
+    autobatch,
+    backends,
+    batching,
+    checkpoint,
+    decoding,
+    instrument,
+    parallel,
+    sampling,
+    scoring,
+    templating,
+    utils,
+)
+from contextlib import ExitStack, contextmanager
+from itertools import product
+from torch.utils.data import DataLoader
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BatchEncoding,
+    LogitsProcessorList,
+    set_seed,
+)
+from minicons import scorer
+from tqdm import tqdm
+
+
+REJECTION = "No, that's not true!"
+
+# --early_stop: the dialog template leaves a quote open for the reply, and
+# both settings ask for a single sentence.
+DIALOG_STOP_STRINGS = ['"', ".", "!", "?"]
+INSTRUCT_STOP_STRINGS = [".", "!", "?"]
+
+
+def join(prompt, decoded_sentence):
+    if decoded_sentence.startswith(" "):
+        return f"{prompt}{decoded_sentence}"
+    else:
+        return f"{prompt} {decoded_sentence}"
+
+
+@instrument.timed("rescore")
+def rescore(lm, joined, max_tokens=None):
+    """
+    The original scoring path: re-tokenize prompt + continuation and run
+    `sequence_score` over them. With `max_tokens`, the sequences are sorted by
+    length and batched by token budget (see `batching.budget_sequence_score`).
+    """
+    lm.tokenizer.padding_side = "right"
+    if max_tokens is None:
+        decoded_scores = lm.sequence_score(joined)
+    else:
+        decoded_scores, _ = batching.budget_sequence_score(
+            lm, joined, max_tokens, verbose=False
+        )
+    lm.tokenizer.padding_side = "left"
+
+    return decoded_scores
+
+
+def ranking(scores):
+    """sample indices, best score first."""
+    return sorted(range(len(scores)), key=lambda j: -scores[j])
+
+
+def report_score_gap(generated_scores, rescored, tolerance):
+    """
+    For --verify_scores: how far a batch's generate-time scores are from what
+    `rescore` stores by default, and for how many items they would rank the
+    samples (and so pick the top continuations in `coalesce`) differently.
+    """
+    diffs = [[abs(a - b) for a, b in zip(g, r)] for g, r in zip(generated_scores, rescored)]
+    flat = [d for item in diffs for d in item]
+    over = sum(max(item, default=0.0) > tolerance for item in diffs)
+    reordered = sum(ranking(g) != ranking(r) for g, r in zip(generated_scores, rescored))
+    print(
+        f"{'Warning: ' if over else ''}generate-time scores differ from rescoring by "
+        f"up to {max(flat, default=0.0):.6f} (mean {sum(flat) / max(len(flat), 1):.6f}); "
+        f"{over}/{len(diffs)} items over the tolerance, "
+        f"{reordered}/{len(diffs)} ranked differently"
+    )
+
+
+def sample(
+    lm, encoded, p, k, t, num_gen, max_new, seeds=None, output_logits=False, sample_offset=0
+):
+    """sampling with `generate`, see `generate_and_decode`."""
+    sampling_kwargs = {"top_p": p, "temperature": t, "top_k": k}
+    per_row = isinstance(p, (list, tuple))
+    if per_row or seeds is not None:
+        if not per_row:
+            n = len(encoded.input_ids)
+            p, k, t = [p] * n, [k] * n, [t] * n
+
+        # one (p, k, t) per row: switch off the built-in warpers and apply
+        # them per row after the repetition penalty instead.
+        processors = [
+            sampling.PerRowSamplingWarper(
+                top_p=[x for x in p for _ in range(num_gen)],
+                top_k=[x for x in k for _ in range(num_gen)],
+                temperature=[x for x in t for _ in range(num_gen)],
+            )
+        ]
+        if seeds is not None:
+            # one random stream per (prompt, sample)
+            processors.append(
+                sampling.PerRowSeededSampler(
+                    [
+                        sampling.stream_seed(seed, sample_offset + j)
+                        for seed in seeds
+                        for j in range(num_gen)
+                    ]
+                )
+            )
+        sampling_kwargs = {
+            "top_p": None,
+            "temperature": 1.0,
+            "top_k": 0,
+            "logits_processor": LogitsProcessorList(processors),
+        }
+
+    generations = lm.model.generate(
+        **encoded,
+        num_return_sequences=num_gen,
+        max_new_tokens=max_new,
+        do_sample=True,
+        tokenizer=lm.tokenizer,
+        repetition_penalty=1.2,
+        **sampling_kwargs,
+        return_dict_in_generate=output_logits,
+        output_logits=output_logits,
+    )
+
+    return generations
+
+
+def generate_and_decode(
+    lm,
+    batch,
+    p,
+    k,
+    t,
+    num_gen=10,
+    max_new=20,
+    device="cuda:0",
+    score_from_generate=False,
+    verify_scores=False,
+    tolerance=1e-3,
+    encoded=None,
+    max_tokens=None,
+    seeds=None,
+    seed=1024,
+    stop_strings=None,
+    sample_offset=0,
+):
+    """
+    p, k and t are either single values for the whole batch, or lists with one
+    value per row of `batch` (see `sampling.PerRowSamplingWarper`).
+
+    If `score_from_generate` is True, the stored scores are computed from the
+    logits returned by `generate` (plus one pass over the prompts), instead of
+    re-running all num_gen x batch sequences through `sequence_score`. These
+    scores are of the sampled tokens, which is not the sequence `rescore`
+    scores: `join` puts a space between prompt and continuation unless the
+    continuation starts with one, and the re-tokenized string may get other
+    merges or (with some templates) a second BOS token. The two can differ
+    by 1e-2 or more, which can change the samples `coalesce` keeps. With
+    `verify_scores`, the continuations are also rescored as they are by
+    default, and the gap is reported (see `report_score_gap`).
+
+    `encoded` can be passed in to skip tokenizing the batch again, and
+    `max_tokens` switches the rescoring to token-budget batches.
+
+    `seeds` (one per row of `batch`) gives every (row, sample) its own random
+    stream (see `sampling.PerRowSeededSampler`), so that samples no longer
+    depend on the batch size or on where an item falls in the batch order.
+    Sample numbers start at `sample_offset`, so that drawing samples in
+    several calls gives the same samples as a single call. Without `seeds`,
+    `set_seed(seed)` is called once per batch.
+
+    With `stop_strings` (a list, possibly empty), every sequence stops at the
+    first stop string or end-of-turn token, and finished sequences are
+    dropped from the batch (see `decoding.generate_until_stop`).
+    """
+    if encoded is None:
+        encoded = lm.tokenizer(
+            batch, return_tensors="pt", add_special_tokens=False, padding=True
+        )
+        encoded = encoded.to(device)
+
+    input_length = encoded.input_ids.shape[-1] # store input lengths
+
+    """
+    inputs = ["sentence1", "sentence2", ..., "sentence8"]
+    encoded.input_ids = [[1x50], [1x50], ..., ]
+    encoded.input_ids' shape = [batch_size, input_length]
+    For example, shape of encoded.input_ids:
+    [8, 50]
+
+    Let's say these are the lengths of the generations: 
+    [[1x100], [1x100], ]
+
+    """
+
+    set_seed(seed)
+
+    with instrument.stage("sample"):
+        if stop_strings is not None:
+            if not isinstance(p, (list, tuple)):
+                p, k, t = [p] * len(batch), [k] * len(batch), [t] * len(batch)
+
+            # our own sampling loop, which drops rows from the batch once they
+            # reach a stop string or an end-of-turn token.
+            generations = decoding.generate_until_stop(
+                lm,
+                encoded,
+                top_p=p,
+                top_k=k,
+                temperature=t,
+                num_gen=num_gen,
+                max_new=max_new,
+                stop_strings=stop_strings,
+                seeds=seeds,
+                repetition_penalty=1.2,
+                output_logits=score_from_generate,
+                sample_offset=sample_offset,
+            )
+        else:
+            generations = sample(
+                lm,
+                encoded,
+                p,
+                k,
+                t,
+                num_gen,
+                max_new,
+                seeds,
+                score_from_generate,
+                sample_offset,
+            )
+
+    if score_from_generate:
+        generated = generations.sequences[:, input_length:]
+        generated_scores = scoring.generated_sequence_scores(
+            lm, encoded, generated, generations.logits, num_gen
+        )
+        generated_scores = list(utils.divide_chunks(generated_scores, num_gen))
+        generations = generations.sequences
+
+    decoded = []
+
+    """
+    decoded = [
+        [generation1_1, generation1_2, ..., generation1_10], 
+        [generation2_1, generation2_2, ..., generation2_10],  
+        ...
+    ]    
+    """
+
+    with instrument.stage("detokenize"):
+        decoded_sentences = [
+            lm.tokenizer.batch_decode(gen, skip_special_tokens=True)
+            for gen in generations[:, input_length:].split([num_gen] * len(batch))
+        ]
+
+    if (not score_from_generate and max_tokens is not None) or (
+        score_from_generate and verify_scores
+    ):
+        # rescore all num_gen x batch sequences at once (in token-budget
+        # batches with max_tokens)
+        joined = [join(batch[i], d) for i, ds in enumerate(decoded_sentences) for d in ds]
+        rescored = list(utils.divide_chunks(rescore(lm, joined, max_tokens), num_gen))
+        if score_from_generate:
+            report_score_gap(generated_scores, rescored, tolerance)
+
+    for i, sentences in enumerate(decoded_sentences):
+        if score_from_generate:
+            decoded_scores = generated_scores[i]
+        elif max_tokens is not None:
+            decoded_scores = rescored[i]
+        else:
+            decoded_scores = rescore(lm, [join(batch[i], d) for d in sentences])
+
+        decoded.append(list(zip(sentences, decoded_scores)))
+
+    return decoded
+
+
+def adaptive_generate_and_decode(
+    lm,
+    batch,
+    p,
+    k,
+    t,
+    encoded,
+    seeds,
+    num_gen=10,
+    round_size=5,
+    top_k_stable=10,
+    patience=2,
+    max_duplicate_rate=0.5,
+    **kwargs,
+):
+    """
+    Like `generate_and_decode`, but samples in rounds of `round_size` and
+    stops sampling a prompt once either
+    - the top `top_k_stable` unique continuations (by log-prob) have stayed
+      the same for `patience` rounds, or
+    - at least `max_duplicate_rate` of its samples so far are duplicates,
+    or once it has `num_gen` samples. Prompts that are still going are
+    sampled together in the next round.
+
+    Needs `seeds`: samples are numbered across rounds, so every prompt gets
+    exactly the first n samples it would get with num_gen=n.
+    Remaining kwargs go to `generate_and_decode`.
+    """
+    decoded = [[] for _ in batch]
+    top = [None] * len(batch)
+    stable = [0] * len(batch)
+    active = list(range(len(batch)))
+
+    offset = 0
+    while active and offset < num_gen:
+        rows = torch.tensor(active)
+        subset = BatchEncoding({key: value[rows] for key, value in encoded.items()})
+        if isinstance(p, (list, tuple)):
+            row_p, row_k, row_t = [[x[i] for i in active] for x in (p, k, t)]
+        else:
+            row_p, row_k, row_t = p, k, t
+
+        n = min(round_size, num_gen - offset)
+        round_decoded = generate_and_decode(
+            lm,
+            [batch[i] for i in active],
+            p=row_p,
+            k=row_k,
+            t=row_t,
+            num_gen=n,
+            encoded=subset,
+            seeds=[seeds[i] for i in active],
+            sample_offset=offset,
+            **kwargs,
+        )
+        offset += n
+
+        still_active = []
+        for i, samples in zip(active, round_decoded):
+            decoded[i].extend(samples)
+
+            ranked = sorted(set(decoded[i]), key=lambda x: -x[-1])
+            current = {sentence for sentence, _ in ranked[:top_k_stable]}
+            stable[i] = stable[i] + 1 if current == top[i] else 0
+            top[i] = current
+
+            duplicate_rate = 1 - len({s for s, _ in decoded[i]}) / len(decoded[i])
+            if stable[i] < patience and duplicate_rate < max_duplicate_rate:
+                still_active.append(i)
+        active = still_active
+
+    return decoded
+
+
+@instrument.timed("template")
+def build_stimuli(analysis_data, tok, instruct=False, response=None):
+    """
+    Returns (idx, stimulus_vp1, stimulus_vp2) for every item in the analysis data.
+    """
+    stimuli = []
+    for i, entry in enumerate(analysis_data):
+        idx = i + 1
+        sentence1 = f"{entry['subj']} {entry['vp1']}"
+        sentence2 = f"{entry['subj']} {entry['vp2']}"
+        if instruct:
+            sentence1, sentence2 = f"{sentence1}.", f"{sentence2}."
+            stimulus1 = templating.render_chat(
+                sentence1, tok=tok, response_prompt=response
+            )
+            stimulus2 = templating.render_chat(
+                sentence2, tok=tok, response_prompt=response
+            )
+        else:
+            stimulus1 = templating.dialog_template(
+                name1=entry["name1"],
+                name2=entry["name2"],
+                preamble=sentence1,
+                response_prompt=response,
+            )
+            stimulus2 = templating.dialog_template(
+                name1=entry["name1"],
+                name2=entry["name2"],
+                preamble=sentence2,
+                response_prompt=response,
+            )
+
+        stimuli.append((idx, stimulus1, stimulus2))
+
+    return stimuli
+
+
+def encode_prompts(tokenizer, prompts):
+    """
+    `tokenizer(prompts, add_special_tokens=False, padding=True)`, with the
+    template pieces tokenized once (see `templating.encode`).
+    """
+    with instrument.stage("tokenize"):
+        input_ids = templating.encode(tokenizer, prompts, add_special_tokens=False)
+    with instrument.stage("pad"):
+        return tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+
+
+def encode_batches(tokenizer, stimuli, batch_size=8, device="cpu"):
+    """
+    Batches the stimuli and tokenizes each batch once, so that the encodings can
+    be reused across generation configs.
+    """
+    encoded_batches = []
+    for idx, stimuli1, stimuli2 in DataLoader(stimuli, batch_size=batch_size):
+        encoded1, encoded2 = [
+            encode_prompts(tokenizer, s).to(device) for s in (stimuli1, stimuli2)
+        ]
+        encoded_batches.append((idx.tolist(), stimuli1, stimuli2, encoded1, encoded2))
+
+    return encoded_batches
+
+
+def auto_batch_size(tokenizer, stimuli, args):
+    """
+    With --auto_batch, the batch size whose decode batch (num_gen rows of the
+    longest prompt plus max_gen tokens per item) fits in the token budget of
+    the running stage; otherwise --batch_size.
+    """
+    max_tokens = autobatch.max_tokens()
+    if max_tokens is None:
+        return args.batch_size
+
+    prompts = [stimulus for _, s1, s2 in stimuli for stimulus in (s1, s2)]
+    longest = max(map(len, templating.encode(tokenizer, prompts, add_special_tokens=False)))
+    batch_size = max_tokens // (args.num_gen * (longest + args.max_gen))
+    batch_size = max(1, min(batch_size, len(stimuli)))
+    print(f"autobatch: batch size {batch_size} for prompts of up to {longest} tokens")
+    return batch_size
+
+
+def item_seeds(args, idx, vp, configs, response=None):
+    """
+    Per-item seeds derived from (seed, item idx, vp type, config), or None if
+    --seeded_streams is off.
+    """
+    if not args.seeded_streams:
+        return None
+    return [
+        sampling.stream_seed(args.seed, i, vp, *config, response)
+        for i, config in zip(idx, configs)
+    ]
+
+
+def take_rows(batch, rows):
+    """
+    The rows `rows` of a batch from `encode_batches` or `pack_batches`, without
+    the left padding that only the other rows needed.
+    """
+    if len(rows) == len(batch[0]):
+        return batch
+
+    taken = []
+    for field in batch:
+        if isinstance(field, BatchEncoding):
+            index = torch.tensor(rows, device=field.input_ids.device)
+            # the columns that are padding in every taken row are all on the left
+            start = int((field.attention_mask[index].sum(0) == 0).sum())
+            field = BatchEncoding({key: value[index, start:] for key, value in field.items()})
+        else:
+            field = [field[i] for i in rows]
+        taken.append(field)
+    return tuple(taken)
+
+
+def generate_batch(lm, batch, args, response=None, config=None):
+    """
+    Generates for one batch and returns [(config, idx, decoded vp1, decoded vp2)]
+    for its rows. With `config`, the batch comes from `encode_batches` and all
+    rows use that (p, k, t); otherwise it comes from `pack_batches` and every
+    row carries its own. Kept at module level so that it can be sent to
+    --workers processes.
+
+    With --auto_batch, a batch that runs out of memory is run in parts (see
+    `autobatch`); with --seeded_streams, its samples are still the same.
+    """
+    *_, encoded1, encoded2 = batch
+    width = max(encoded1.input_ids.shape[1], encoded2.input_ids.shape[1])
+    return autobatch.run(
+        list(range(len(batch[0]))),
+        lambda rows: decode_batch(lm, take_rows(batch, rows), args, response, config),
+        lambda rows: len(rows) * args.num_gen * (width + args.max_gen),
+    )
+
+
+def decode_batch(lm, batch, args, response=None, config=None):
+    """`generate_batch`, in one part."""
+    if config is None:
+        row_configs, *batch = batch
+        topp, topk, temp = [list(x) for x in zip(*row_configs)]
+    else:
+        topp, topk, temp = config
+        row_configs = [config] * len(batch[0])
+    idx, stimuli1, stimuli2, encoded1, encoded2 = batch
+
+    decode = generate_and_decode
+    if args.adaptive:
+        decode = functools.partial(
+            adaptive_generate_and_decode,
+            round_size=args.round_size,
+            top_k_stable=args.top_k_stable,
+            patience=args.patience,
+            max_duplicate_rate=args.max_duplicate_rate,
+        )
+
+    decoded1, decoded2 = [
+        decode(
+            lm,
+            stimuli,
+            p=topp,
+            k=topk,
+            t=temp,
+            num_gen=args.num_gen,
+            max_new=args.max_gen,
+            device=args.device,
+            score_from_generate=args.score_from_generate,
+            verify_scores=args.verify_scores,
+            tolerance=args.score_tolerance,
+            encoded=encoded,
+            max_tokens=args.max_tokens,
+            seeds=item_seeds(args, idx, vp, row_configs, response),
+            seed=args.seed,
+            stop_strings=early_stop_strings(args),
+        )
+        for vp, stimuli, encoded in (
+            ("vp1", stimuli1, encoded1),
+            ("vp2", stimuli2, encoded2),
+        )
+    ]
+
+    return list(zip(row_configs, idx, decoded1, decoded2))
+
+
+def early_stop_strings(args):
+    """stop strings for --early_stop, or None to always decode --max_gen tokens."""
+    if not args.early_stop:
+        return None
+    if args.stop_strings is not None:
+        return args.stop_strings
+    return INSTRUCT_STOP_STRINGS if args.instruct else DIALOG_STOP_STRINGS
+
+
+def run_batches(batches, run_batch, lm=None, pool=None, ckpt=None):
+    """
+    Calls `run_batch(lm, batch)` on every batch, or hands the batches out to
+    the workers of `pool`, and yields the per-batch records in order, as soon
+    as they are done. With a checkpoint, each record is also saved as a
+    shard, and batches that are already in the checkpoint are read back from
+    their shards instead of being run again.
+    """
+    done = ckpt.done() if ckpt is not None else set()
+    todo = [j for j in range(len(batches)) if j not in done]
+
+    if pool is None:
+        outputs = (run_batch(lm, batches[j]) for j in todo)
+    else:
+        outputs = pool.map(run_batch, [batches[j] for j in todo])
+
+    for j in tqdm(range(len(batches))):
+        if j in done:
+            yield ckpt.record(j)
+            continue
+
+        with instrument.step():
+            record = next(outputs)
+        if ckpt is not None:
+            ckpt.write(j, record)
+        yield record
+
+
+def results_meta(args, config, response=None):
+    topp, topk, temp = config
+    meta = {
+        "model": args.model,
+        "instruct": args.instruct,
+        "top_p": topp,
+        "top_k": topk,
+        "temperature": temp,
+        "num_generations": args.num_gen,
+        "max_gen": args.max_gen,
+        "response": response,
+    }
+    if args.backend != "fp32":
+        meta["backend"] = args.backend
+    return meta
+
+
+@contextmanager
+def open_results(path, meta):
+    """
+    Opens the output file for one config and yields `add(idx, vp, sentences)`,
+    which adds the generations of one item.
+
+    For a .jsonl path, the first line holds `meta`, and every sample is
+    written out as its own line as soon as it is added:
+        {"idx": 1, "vp": "vp1", "sample": 0, "sentence": ..., "logprob": ...}
+    Any other path gets the legacy single JSON dict, which is only written
+    once all items are in. Either way, the file only appears at `path` once
+    it is complete.
+    """
+    with checkpoint.atomic_path(path) as tmp:
+        if str(path).endswith(".jsonl"):
+            with open(tmp, "w") as f:
+                f.write(json.dumps({"meta": meta}) + "\n")
+
+                @instrument.timed("write")
+                def add(idx, vp, sentences):
+                    for i, (sentence, logprob) in enumerate(sentences):
+                        record = {
+                            "idx": idx,
+                            "vp": vp,
+                            "sample": i,
+                            "sentence": sentence,
+                            "logprob": logprob,
+                        }
+                        f.write(json.dumps(record) + "\n")
+
+                yield add
+        else:
+            results = {
+                **meta,
+                "generation_vp1": [],  # {id, list}
+                "generation_vp2": [],  # {id, list}
+            }
+
+            def add(idx, vp, sentences):
+                results[f"generation_{vp}"].append({"idx": idx, "sentences": sentences})
+
+            yield add
+            with instrument.stage("write"):
+                utils.write_json(results, tmp)
+
+
+def write_sample_counts(counts, path):
+    """
+    --adaptive: writes how many samples every (item, vp type) got next to
+    the results, as {results stem}.sample_counts.csv.
+    """
+    samples = [n for _, _, n in counts]
+    print(
+        f"Adaptive sampling: {sum(samples)} samples for {len(samples)} prompts "
+        f"(mean {sum(samples) / max(len(samples), 1):.1f}, min {min(samples, default=0)}, "
+        f"max {max(samples, default=0)})"
+    )
+    counts_path = pathlib.Path(path).with_suffix(".sample_counts.csv")
+    with checkpoint.atomic_path(counts_path) as tmp:
+        utils.write_csv(sorted(counts), tmp, header=["idx", "vp", "samples"])
+
+
+def collect(lm, batches, config, args, path, response=None, ckpt=None, pool=None):
+    """
+    Runs generation over pre-encoded batches for a single (p, k, t) config,
+    writing the results to `path` as they come in.
+    """
+    run_batch = functools.partial(
+        generate_batch, args=args, response=response, config=config
+    )
+    counts = []
+    with open_results(path, results_meta(args, config, response)) as add:
+        for j, record in enumerate(run_batches(batches, run_batch, lm, pool, ckpt)):
+            if j == 0:
+                print([d1 for _, _, d1, _ in record[:5]])
+
+            for _, i, d1, d2 in record:
+                add(i, "vp1", d1)
+                add(i, "vp2", d2)
+                counts.extend([(i, "vp1", len(d1)), (i, "vp2", len(d2))])
+
+    if args.adaptive:
+        write_sample_counts(counts, path)
+
+
+def pack_batches(tokenizer, stimuli, configs, batch_size=8, device="cpu"):
+    """
+    Like `encode_batches`, but every (config, item) pair is a row, so that
+    rows with different sampling configs can share a batch.
+    configs: list of (top_p, top_k, temperature)
+    """
+    rows = [(config, *stimulus) for config in configs for stimulus in stimuli]
+
+    packed = []
+    for chunk in utils.divide_chunks(rows, batch_size):
+        row_configs, idx, stimuli1, stimuli2 = [list(x) for x in zip(*chunk)]
+        encoded1, encoded2 = [
+            encode_prompts(tokenizer, s).to(device) for s in (stimuli1, stimuli2)
+        ]
+        packed.append((row_configs, idx, stimuli1, stimuli2, encoded1, encoded2))
+
+    return packed
+
+
+def collect_packed(lm, batches, paths, args, response=None, ckpt=None, pool=None):
+    """
+    Runs generation over batches from `pack_batches`, and splits the output
+    back into one results file per config, as the batches come in.
+    paths: {config: output path}
+    """
+    run_batch = functools.partial(generate_batch, args=args, response=response)
+    counts = {config: [] for config in paths}
+    with ExitStack() as stack:
+        adders = {
+            config: stack.enter_context(
+                open_results(path, results_meta(args, config, response))
+            )
+            for config, path in paths.items()
+        }
+        for record in run_batches(batches, run_batch, lm, pool, ckpt):
+            for config, i, d1, d2 in record:
+                add = adders[tuple(config)]
+                add(i, "vp1", d1)
+                add(i, "vp2", d2)
+                counts[tuple(config)].extend([(i, "vp1", len(d1)), (i, "vp2", len(d2))])
+
+    if args.adaptive:
+        for config, path in paths.items():
+            write_sample_counts(counts[config], path)
+
+
+def make_checkpoint(args, name, **meta):
+    """
+    Checkpoint for one output, kept under {outdir}/checkpoints/{name}, or None
+    if checkpointing is off.
+    """
+    if not (args.checkpoint or args.resume):
+        return None
+
+    meta.update(
+        {
+            "model": args.model,
+            "instruct": args.instruct,
+            "num_gen": args.num_gen,
+            "max_gen": args.max_gen,
+            "batch_size": args.batch_size,
+            "analysis_data": args.analysis_data,
+            "score_from_generate": args.score_from_generate,
+            "max_tokens": args.max_tokens,
+            "seeded_streams": args.seeded_streams,
+            "backend": args.backend,
+            "seed": args.seed,
+            "stop_strings": early_stop_strings(args),
+            "adaptive": (
+                [args.round_size, args.top_k_stable, args.patience, args.max_duplicate_rate]
+                if args.adaptive
+                else None
+            ),
+        }
+    )
+    return checkpoint.Checkpoint(
+        f"{args.outdir}/checkpoints/{name}", meta=meta, resume=args.resume
+    )
+
+
+def load_tokenizer(model):
+    """the tokenizer set up the way `load_model` sets it up."""
+    tokenizer = AutoTokenizer.from_pretrained(model)
+    tokenizer.padding_side = "left"
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+
+    return tokenizer
+
+
+def load_model(model, device, backend="fp32"):
+    lm = scorer.IncrementalLMScorer(model, device=device)
+    backends.apply(lm.model, backend)
+    lm.tokenizer.padding_side = "left"
+
+    if lm.tokenizer.pad_token is None:
+        lm.tokenizer.pad_token_id = lm.tokenizer.eos_token_id
+
+    return lm
+
+
+def start(args):
+    """
+    Loads the model, or (with --workers > 1) starts the worker processes
+    that each load their own copy. Returns (lm, pool, tokenizer), where
+    exactly one of lm and pool is None. With --auto_batch, also starts
+    sizing the batches (see `autobatch`).
+    """
+    if args.workers > 1:
+        pool = parallel.WorkerPool(
+            functools.partial(load_model, args.model, args.device, args.backend),
+            args.workers,
+            args.threads,
+        )
+        return None, pool, load_tokenizer(args.model)
+
+    lm = load_model(args.model, args.device, args.backend)
+    if args.auto_batch:
+        autobatch.start(
+            args.model,
+            "generate",
+            lm.model,
+            args.device,
+            args.batch_sizes,
+            args.batch_memory,
+            scoring=False,
+        )
+    return lm, None, lm.tokenizer
+
+
+def finish(pool, stage, rows, seconds, args):
+    if pool is not None:
+        pool.close()
+    parallel.report_throughput(
+        stage,
+        args.workers,
+        pool.threads if pool is not None else torch.get_num_threads(),
+        rows,
+        seconds,
+        args.throughput_report,
+    )
+
+
+def main(args):
+    if args.resume and pathlib.Path(f"{args.outdir}/{args.outfile}").exists():
+        print(f"{args.outdir}/{args.outfile} already exists, nothing to resume.")
+        return
+
+    lm, pool, tokenizer = start(args)
+    instrument.start(
+        lm.model if lm is not None else None,
+        args.profile_batches,
+        args.profile_dir,
+        label=pathlib.Path(args.outfile).stem,
+    )
+
+    topp = args.topp
+    if topp == -1:
+        topp = None
+
+    response = args.response  # none or actual string
+
+    # read eval/analysis data
+    analysis_data = utils.read_csv_dict(args.analysis_data)
+
+    # stimuli generation:
+    stimuli = build_stimuli(
+        analysis_data, tokenizer, instruct=args.instruct, response=response
+    )
+    args.batch_size = auto_batch_size(tokenizer, stimuli, args)
+    batches = encode_batches(tokenizer, stimuli, args.batch_size, args.device)
+
+    pathlib.Path(args.outdir).mkdir(exist_ok=True, parents=True)
+    ckpt = make_checkpoint(
+        args,
+        pathlib.Path(args.outfile).stem,
+        top_p=topp,
+        top_k=args.topk,
+        temperature=args.temp,
+        response=response,
+    )
+    with parallel.Timer() as timer:
+        collect(
+            lm,
+            batches,
+            (topp, args.topk, args.temp),
+            args,
+            f"{args.outdir}/{args.outfile}",
+            response,
+            ckpt,
+            pool,
+        )
+    finish(pool, "collect-generations", 2 * len(stimuli), timer.seconds, args)
+    instrument.write_report([f"{args.outdir}/{args.outfile}"], stage="collect-generations")
+    instrument.stop()
+    autobatch.stop()
+
+    if ckpt is not None:
+        ckpt.remove()
+
+
+def sweep_grid(args, mode):
+    """{(top_p, top_k, temperature): output file name} for the --sweep grid of one mode."""
+    grid = {}
+    for k, temp, p in product(args.sweep_topk, args.sweep_temp, args.sweep_topp):
+        topp = None if float(p) == -1 else float(p)
+        p_name = "None" if topp is None else p
+        grid[(topp, int(k), float(temp))] = f"gens_{p_name}_{k}_{temp}_{mode}.jsonl"
+    return grid
+
+
+def sweep(args):
+    """
+    Runs the whole (top_p, top_k, temperature, freeform/rejection) grid in a
+    single process: the model is loaded once and the stimuli for each mode
+    are tokenized once. Writes the same gens_{p}_{k}_{t}_{mode}.jsonl files as
+    scripts/collect-generations-model.sh.
+
+    Grid values are kept as the strings they were passed as so that file
+    names match the shell scripts (e.g., `-p 0` gives gens_0_..., and -1
+    gives gens_None_...).
+
+    With `--pack_configs`, rows from all configs of a mode are packed into
+    the same batches and decoded together with per-row sampling parameters,
+    instead of running the configs one after the other. Samples are drawn
+    from the same distributions, but not with the same random draws as the
+    serial runs.
+    """
+    lm, pool, tokenizer = start(args)
+    analysis_data = utils.read_csv_dict(args.analysis_data)
+    pathlib.Path(args.outdir).mkdir(exist_ok=True, parents=True)
+
+    rows = 0
+    with parallel.Timer() as timer:
+        for mode in args.sweep_modes:
+            # one report per mode, next to each of its outputs
+            instrument.start(
+                lm.model if lm is not None else None,
+                args.profile_batches,
+                args.profile_dir,
+                label=mode,
+            )
+            response = (args.response or REJECTION) if mode == "rejection" else None
+            stimuli = build_stimuli(
+                analysis_data, tokenizer, instruct=args.instruct, response=response
+            )
+
+            grid = sweep_grid(args, mode)
+
+            if args.resume:
+                # outputs are written atomically, so existing ones are complete
+                grid = {
+                    config: outfile
+                    for config, outfile in grid.items()
+                    if not pathlib.Path(f"{args.outdir}/{outfile}").exists()
+                }
+                if not grid:
+                    continue
+
+            rows += 2 * len(stimuli) * len(grid)
+            args.batch_size = auto_batch_size(tokenizer, stimuli, args)
+            if args.pack_configs:
+                configs = list(grid.keys())
+                batches = pack_batches(
+                    tokenizer, stimuli, configs, args.batch_size, args.device
+                )
+                print(f"mode: {mode}, {len(configs)} configs packed into {len(batches)} batches")
+
+                ckpt = make_checkpoint(
+                    args, f"packed_{mode}", configs=configs, response=response
+                )
+                collect_packed(
+                    lm,
+                    batches,
+                    {config: f"{args.outdir}/{grid[config]}" for config in configs},
+                    args,
+                    response,
+                    ckpt,
+                    pool,
+                )
+                if ckpt is not None:
+                    ckpt.remove()
+            else:
+                batches = encode_batches(tokenizer, stimuli, args.batch_size, args.device)
+
+                for (topp, topk, temp), outfile in grid.items():
+                    print(f"p: {topp}, t: {temp}, k: {topk}, mode: {mode}")
+
+                    ckpt = make_checkpoint(
+                        args,
+                        pathlib.Path(outfile).stem,
+                        top_p=topp,
+                        top_k=topk,
+                        temperature=temp,
+                        response=response,
+                    )
+                    collect(
+                        lm,
+                        batches,
+                        (topp, topk, temp),
+                        args,
+                        f"{args.outdir}/{outfile}",
+                        response,
+                        ckpt,
+                        pool,
+                    )
+                    if ckpt is not None:
+                        ckpt.remove()
+
+            instrument.write_report(
+                [f"{args.outdir}/{outfile}" for outfile in grid.values()],
+                stage="collect-generations --sweep",
+                mode=mode,
+            )
+
+    instrument.stop()
+    autobatch.stop()
+    finish(pool, "collect-generations --sweep", rows, timer.seconds, args)
+
+
+def run(args):
+    """`dgrc generate`: the whole grid with --sweep, otherwise one config."""
+    if args.sweep:
+        sweep(args)
+    else:
+        main(args)
@@ -0,0 +1,11 @@
+"""
+Rejection headers (the "No" and "Hey, wait a minute" variants) shared by the
+stimuli and evaluation stages.
+"""
+
+# the two headers scored by default in `rejection-eval`
+NO_HEADER = "No, that's not true!"
+HEYWAIT_HEADER = "Hey, wait a minute!"
+
+NO = ["No.", "That's not true.", "I doubt that.", "I don't think so."]
+WAIT = ["Wait no.", "Hey, wait a minute.", "Hold on.", "Hang on, hang on."]
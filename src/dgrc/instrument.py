@@ -0,0 +1,242 @@
+"""
+Instrumentation of the hot paths: per-stage wall and CPU time, tokens
+processed vs padded, batch shapes and peak memory, written as a json
+report next to each output file ({output stem}.perf.json).
+
+The hot-path functions mark their stages with `stage(name)` (or the
+`timed(name)` decorator), e.g. "template", "tokenize", "pad", "sample",
+"detokenize", "rescore", "score", "read", "write". Stages nest, and are
+reported by their path, e.g. "score/tokenize". Nothing is recorded until a
+stage calls `start`, so the marks cost next to nothing otherwise.
+
+`start(model=...)` also hooks the forward pass of the model: every forward
+is recorded as a "prefill" (a full sequence) or a "decode" step (one token)
+under the current stage, and the prefill forwards are where the tokens,
+padding and batch shapes are counted. Forwards run in --workers processes
+are not seen by the main process.
+
+With --profile_batches, the torch profiler traces the selected batches
+(counted over the `step`s of a run: generation batches, scoring batches)
+to chrome traces in --profile_dir ({label}-batch-{i}.json).
+"""
+
+import functools
+import json
+import pathlib
+import resource
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from dgrc import checkpoint
+
+# the recorder of the running stage, if any
+_recorder = None
+
+
+def cuda():
+    """torch, if the stage uses it (coalesce runs without) and has a gpu."""
+    torch = sys.modules.get("torch")
+    return torch if torch is not None and torch.cuda.is_available() else None
+
+
+class Recorder:
+    def __init__(self, profile_batches=(), profile_dir="profiles", label="run"):
+        self.stages = {}
+        self.tokens = 0
+        self.padded = 0
+        self.shapes = Counter()
+        self.steps = 0
+        self.profile_batches = set(profile_batches or ())
+        self.profile_dir = profile_dir
+        self.label = label
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = (time.perf_counter(), time.process_time())
+        if cuda() is not None:
+            cuda().cuda.reset_peak_memory_stats()
+
+    def path(self):
+        """this thread's stack of open stages, and of open forward passes."""
+        if not hasattr(self.local, "stack"):
+            self.local.stack, self.local.forwards = [], []
+        return self.local.stack
+
+    def add(self, name, wall, cpu):
+        with self.lock:
+            record = self.stages.setdefault(
+                name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+            )
+            record["calls"] += 1
+            record["wall_seconds"] += wall
+            record["cpu_seconds"] += cpu
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.path()
+        stack.append(name)
+        key = "/".join(stack)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.add(key, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def count_batch(self, input_ids, attention_mask=None):
+        rows, length = input_ids.shape
+        tokens = rows * length
+        if attention_mask is not None:
+            # with a cached prefix, the mask also covers the past tokens
+            tokens = int(attention_mask[:, -length:].sum())
+        with self.lock:
+            self.tokens += tokens
+            self.padded += rows * length - tokens
+            self.shapes[f"{rows}x{length}"] += 1
+
+    def watch(self, model):
+        """times and counts every forward pass of `model`."""
+        synchronize = next(model.parameters()).is_cuda
+
+        def before(module, args, kwargs):
+            self.path()
+            input_ids = kwargs.get("input_ids", args[0] if args else None)
+            if input_ids is None:
+                self.local.forwards.append(None)
+                return
+            name = "prefill" if input_ids.shape[-1] > 1 else "decode"
+            if name == "prefill":
+                self.count_batch(input_ids, kwargs.get("attention_mask"))
+            scope = self.stage(name)
+            scope.__enter__()
+            self.local.forwards.append(scope)
+
+        def after(module, args, kwargs, output):
+            scope = self.local.forwards.pop()
+            if scope is not None:
+                if synchronize:
+                    cuda().cuda.synchronize()
+                scope.__exit__(None, None, None)
+
+        self.hooks.append(model.register_forward_pre_hook(before, with_kwargs=True))
+        self.hooks.append(model.register_forward_hook(after, with_kwargs=True))
+
+    @contextmanager
+    def step(self):
+        """one batch of the run, traced if it was selected with --profile_batches."""
+        i = self.steps
+        self.steps += 1
+        if i not in self.profile_batches:
+            yield
+            return
+
+        import torch
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if cuda() is not None:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True
+        ) as profiler:
+            yield
+        pathlib.Path(self.profile_dir).mkdir(exist_ok=True, parents=True)
+        trace = f"{self.profile_dir}/{self.label}-batch-{i}.json"
+        profiler.export_chrome_trace(trace)
+        print(f"instrument: traced batch {i} to {trace}")
+
+    def report(self, **meta):
+        wall, cpu = self.start
+        return {
+            **meta,
+            "wall_seconds": round(time.perf_counter() - wall, 4),
+            "cpu_seconds": round(time.process_time() - cpu, 4),
+            "stages": {
+                name: {
+                    "calls": record["calls"],
+                    "wall_seconds": round(record["wall_seconds"], 4),
+                    "cpu_seconds": round(record["cpu_seconds"], 4),
+                }
+                for name, record in sorted(self.stages.items())
+            },
+            "tokens": {
+                "processed": self.tokens,
+                "padded": self.padded,
+                "padding_rate": round(self.padded / (self.tokens + self.padded), 4)
+                if self.tokens + self.padded
+                else None,
+            },
+            "batch_shapes": dict(self.shapes.most_common()),
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "peak_cuda_mb": round(cuda().cuda.max_memory_allocated() / 2**20, 1)
+            if cuda() is not None
+            else None,
+        }
+
+    def close(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+
+def start(model=None, profile_batches=(), profile_dir="profiles", label="run"):
+    """
+    Starts recording (replacing the running recorder), watching the forward
+    passes of `model` if given. Traces are named after `label`. Returns the
+    recorder.
+    """
+    global _recorder
+    stop()
+    _recorder = Recorder(profile_batches, profile_dir, label)
+    if model is not None:
+        _recorder.watch(model)
+    return _recorder
+
+
+def stop():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+def stage(name):
+    return nullcontext() if _recorder is None else _recorder.stage(name)
+
+
+def step():
+    return nullcontext() if _recorder is None else _recorder.step()
+
+
+def timed(name):
+    """decorator: the function is the stage `name`."""
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def report_path(output):
+    path = pathlib.Path(output)
+    return path.with_name(f"{path.stem}.perf.json")
+
+
+def write_report(outputs, **meta):
+    """writes the report of the running recorder next to each of `outputs`."""
+    if _recorder is None:
+        return
+    report = _recorder.report(**meta, outputs=[str(output) for output in outputs])
+    for output in outputs:
+        with checkpoint.atomic_path(report_path(output)) as tmp:
+            with open(tmp, "w") as f:
+                json.dump(report, f, indent=1)
@@ -0,0 +1,111 @@
+"""
+Sequence scores from the log-probs of the scored tokens only
+(--gather_logprobs).
+
+`lm.sequence_score` runs the whole model and takes the log-softmax of the
+logits at every position of every row: a batch x length x vocabulary
+tensor, and a few more of its size, which is most of the peak memory of a
+scoring batch with a large vocabulary. Here the model is run up to its last
+hidden states, and its output layer only on the positions that count
+towards the score, --logprob_chunk of them at a time. Each chunk only keeps
+the log-prob of its target token (its logit minus the logsumexp of the
+chunk's logits); the logits themselves are dropped before the next chunk.
+
+With bow_correction, minicons adds the beginning-of-word mass of the next
+position to every word-final token, and takes the same mass off the token
+that follows. The two cancel out except at the last token, whose next
+position is past the end of the sequence, so only the bow mass of every
+row's last position is needed.
+
+Scores match `lm.sequence_score` up to float rounding. Models whose logits
+are more than the output layer applied to the last hidden states (e.g.
+soft-capped or scaled logits) are scored with `lm.sequence_score`.
+"""
+
+import torch
+
+from dgrc import instrument
+
+# config attributes of models that transform the output layer's logits
+LOGIT_TRANSFORMS = ("final_logit_softcapping", "logit_scale", "logits_scaling")
+
+
+def supported(lm):
+    model = lm.model
+    return (
+        model.base_model is not model
+        and model.get_output_embeddings() is not None
+        and not any(getattr(model.config, name, None) for name in LOGIT_TRANSFORMS)
+    )
+
+
+def chunked(head, hidden, chunk_size, reduce):
+    """
+    `reduce(logits, span)` of the output layer over `hidden`, `chunk_size`
+    rows (the slice `span`) at a time.
+    """
+    return torch.cat(
+        [
+            reduce(head(hidden[span]).float(), span)
+            for span in (
+                slice(start, start + chunk_size) for start in range(0, len(hidden), chunk_size)
+            )
+        ]
+    )
+
+
+def sequence_score(lm, encoded, bow_correction=False, chunk_size=256):
+    """
+    `lm.sequence_score(encoded, bow_correction=...)` (mean token log-prob,
+    first token ignored) over a padded batch, without the full log-softmax.
+    """
+    if not supported(lm):
+        return lm.sequence_score(encoded, bow_correction=bow_correction)
+
+    device = lm.model.device
+    input_ids = encoded["input_ids"].to(device)
+    attention_mask = encoded["attention_mask"].to(device)
+
+    # the real tokens, row by row; every one but the last of its row is
+    # scored on the next one
+    rows, columns = attention_mask.bool().nonzero(as_tuple=True)
+    lengths = attention_mask.sum(1)
+    ends = lengths.cumsum(0) - 1
+    scored = torch.ones(len(rows), dtype=torch.bool, device=device)
+    scored[ends] = False
+    scored = scored.nonzero().squeeze(-1)
+    targets = input_ids[rows, columns][scored + 1].unsqueeze(-1)
+
+    head = lm.model.get_output_embeddings()
+    with torch.no_grad():
+        with instrument.stage("prefill"):
+            hidden = lm.model.base_model(
+                input_ids=input_ids, attention_mask=attention_mask, use_cache=False
+            ).last_hidden_state
+
+        with instrument.stage("logprobs"):
+            token_logprobs = chunked(
+                head,
+                hidden[rows[scored], columns[scored]],
+                chunk_size,
+                lambda logits, span: logits.gather(-1, targets[span]).squeeze(-1)
+                - logits.logsumexp(-1),
+            )
+
+            bow = None
+            if bow_correction and lm.is_bow_tokenizer:
+                bow_idx = torch.tensor(lm.bow_subword_idx, device=device)
+                bow = chunked(
+                    head,
+                    hidden[rows[ends], columns[ends]],
+                    chunk_size,
+                    lambda logits, span: logits.index_select(-1, bow_idx).logsumexp(-1)
+                    - logits.logsumexp(-1),
+                )
+
+    scores = []
+    for i, row in enumerate(token_logprobs.split((lengths - 1).tolist())):
+        if bow is not None:
+            row = torch.cat([row[:-1], row[-1:] + bow[i]])
+        scores.append(row.mean(0).item())
+    return scores
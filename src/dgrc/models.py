@@ -0,0 +1,29 @@
+"""
+Model registry: the Hugging Face ids the pipeline was run on and the short
+names their generations and results are saved under, e.g.
+data/results/sorted-generations/freeform/{savename}-arc.csv and
+data/results/dgrc/freeform-arc/{savename}.csv.
+"""
+
+MODELS = {
+    "meta-llama/Meta-Llama-3-8B-Instruct": "llama-3-8b-instruct",
+    "Qwen/Qwen2.5-0.5B-Instruct": "qwen2.5-500m-instruct",
+    "Qwen/Qwen2.5-1.5B-Instruct": "qwen2.5-1.5b-instruct",
+    "Qwen/Qwen2.5-3B-Instruct": "qwen2.5-3b-instruct",
+    "Qwen/Qwen2.5-7B-Instruct": "qwen2.5-7b-instruct",
+    "meta-llama/Meta-Llama-3-8B": "llama-3-8b",
+    "Qwen/Qwen2.5-0.5B": "qwen2.5-500m",
+    "Qwen/Qwen2.5-1.5B": "qwen2.5-1.5b",
+    "Qwen/Qwen2.5-3B": "qwen2.5-3b",
+    "Qwen/Qwen2.5-7B": "qwen2.5-7b",
+}
+
+
+def savename(model):
+    """The registered short name of `model`, or its id with "/" replaced by "_"."""
+    return MODELS.get(model, model.replace("/", "_"))
+
+
+def is_instruct(model):
+    """instruct-tuned models are prompted with their chat template (--instruct)."""
+    return model.endswith("-Instruct")
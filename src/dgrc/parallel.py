@@ -0,0 +1,120 @@
+"""
+Data-parallel execution on many-core CPU hosts: a pool of worker processes,
+each with its own copy of the model and its own share of the cores.
+
+Work is handed out as a list of items (batches, or shards of stimuli), and
+results come back in the same order as the items, so they can be merged into
+the usual JSON/CSV outputs as if a single process had produced them.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+import torch
+
+from concurrent.futures import ProcessPoolExecutor
+
+# the model held by each worker process
+_lm = None
+_ready = None
+
+
+def _init_worker(loader, threads, ready):
+    global _lm, _ready
+    torch.set_num_threads(threads)
+    _lm = loader()
+    _ready = ready
+
+
+def _wait_ready(_):
+    # blocks until every worker has loaded its model
+    _ready.wait()
+
+
+def _run(task):
+    fn, item = task
+    return fn(_lm, item)
+
+
+class WorkerPool:
+    """
+    loader: a picklable, argument-free function that loads the model
+        (e.g. functools.partial(load_model, model, device)).
+    workers: number of processes.
+    threads: torch threads per worker, defaults to an even split of the cores.
+    """
+
+    def __init__(self, loader, workers, threads=None):
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(loader, self.threads, context.Barrier(workers)),
+        )
+
+        # start all workers (and load all models) up front, so that model
+        # loading doesn't count towards the measured throughput.
+        list(self.executor.map(_wait_ready, range(workers)))
+
+    def map(self, fn, items):
+        """
+        yields fn(lm, item) for every item, in order. `fn` has to be picklable,
+        i.e. a module-level function (or a functools.partial of one).
+        """
+        return self.executor.map(_run, [(fn, item) for item in items])
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def shard(items, n, multiple=1):
+    """
+    splits items into (at most) n contiguous, nearly equal shards. Shard
+    sizes are rounded up to a multiple of `multiple` (e.g. the batch size), so
+    that batches come out the same as in a single process.
+    """
+    size = -(-len(items) // n)
+    size = max(multiple, -(-size // multiple) * multiple)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def report_throughput(stage, workers, threads, rows, seconds, path=None):
+    """
+    Prints rows/sec for a run, and appends it to the jsonl file at `path`, so
+    that runs with different --workers can be compared.
+    """
+    record = {
+        "stage": stage,
+        "workers": workers,
+        "threads_per_worker": threads,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 3) if seconds else None,
+    }
+    print(
+        f"{stage}: {rows} rows in {seconds:.1f}s with {workers} worker(s) x "
+        f"{threads} thread(s) ({record['rows_per_second']} rows/s)"
+    )
+    if path is not None:
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    return record
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
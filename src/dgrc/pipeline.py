@@ -0,0 +1,373 @@
+"""
+Runs the stages of the pipeline as a graph of jobs and only rebuilds the
+outputs that are out of date:
+
+    stimuli                                  data/stimuli/kim22-{arc,coord}-unique.csv
+    generate/{model}/{freeform,rejection}    results/generations/{model}/gens_*_{mode}.jsonl
+    coalesce/{model}                         results/sorted-generations/{mode}/{model}-{arc,coord}.csv
+    eval/{model}/{arc,coord}                 results/dgrc/freeform-{condition}/{model}.csv
+    rejection-eval/{model}/{arc,coord}       results/dgrc/rejection-{condition}/{model}.csv
+
+Every job has a fingerprint: a hash of its stage options, of the files it
+reads and, for the model stages, of the model revision (the hub commit, or
+the file sizes and mtimes of a local model directory). Fingerprints and
+output hashes of finished jobs are kept in {data_dir}/results/pipeline.json.
+A job is rebuilt when its fingerprint changed, or when one of its outputs
+is missing or is not the file it wrote.
+
+Only the stages in --stages (eval and rejection-eval by default) are
+rebuilt. A job of an earlier stage is only run if one of its outputs is
+missing, or if an earlier stage was asked for too; otherwise its outputs
+(e.g. the committed sorted generations) are read as they are, even with no
+manifest entry. Resampling the generations takes `--stages generate ...`. Since downstream jobs hash the files they read, a rebuilt output
+that comes out the same does not make them stale.
+
+Jobs whose dependencies are done run in parallel, each in its own process,
+with one job per entry of --devices (e.g. `--devices cuda:0 cuda:1`, or
+`--devices cpu cpu cpu`); model stages run on the device of their slot.
+"""
+
+import functools
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dgrc import checkpoint, cli, models, score_cache
+
+GENERATION_MODES = ["freeform", "rejection"]
+
+# options that change how a stage runs but not what it writes
+RUNTIME_OPTIONS = {
+    "device",
+    "workers",
+    "threads",
+    "throughput_report",
+    "checkpoint",
+    "resume",
+    "checkpoint_every",
+    "score_cache",
+    "token_store",
+    "profile_batches",
+    "profile_dir",
+    "batch_sizes",
+    "logprob_chunk",
+}
+
+
+class Job:
+    def __init__(self, name, stage, options, deps=(), inputs=(), outputs=(), model=None):
+        """
+        name: unique job name, e.g. "eval/qwen2.5-500m/arc".
+        stage, options: the stage and the options it is run with (see `cli.run`).
+        deps: names of the jobs that have to finish first.
+        inputs: files the job reads, hashed into its fingerprint.
+        outputs: glob patterns of the files the job writes.
+        model: the model the stage loads, if any.
+        """
+        self.name = name
+        self.stage = stage
+        self.options = options
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.model = model
+
+
+def plan(args):
+    """the jobs needed for `args.stages`, in dependency order."""
+    data = args.data_dir
+    results = f"{data}/results"
+    stimuli = {c: f"{data}/stimuli/kim22-{c}-unique.csv" for c in ("arc", "coord")}
+    shared = {
+        "batch_size": args.batch_size,
+        "max_tokens": args.max_tokens,
+        "auto_batch": args.auto_batch,
+        "backend": args.backend,
+    }
+    scoring = {
+        **shared,
+        "score_cache": args.score_cache,
+        "gather_logprobs": args.gather_logprobs,
+        "logprob_chunk": args.logprob_chunk,
+    }
+
+    jobs = {}
+    jobs["stimuli"] = Job(
+        "stimuli",
+        "stimuli",
+        {"analysis_data": f"{data}/kim22_used_items.csv", "outdir": f"{data}/stimuli"},
+        inputs=[f"{data}/kim22_used_items.csv"],
+        outputs=list(stimuli.values()),
+    )
+
+    for model in args.models or list(models.MODELS):
+        name = models.savename(model)
+        instruct = models.is_instruct(model)
+
+        for mode in GENERATION_MODES:
+            jobs[f"generate/{name}/{mode}"] = Job(
+                f"generate/{name}/{mode}",
+                "generate",
+                {
+                    **shared,
+                    "model": model,
+                    "instruct": instruct,
+                    "sweep": True,
+                    "sweep_modes": [mode],
+                    "analysis_data": f"{data}/kim22_used_items.csv",
+                    "outdir": f"{results}/generations/{name}",
+                },
+                inputs=[f"{data}/kim22_used_items.csv"],
+                outputs=[f"{results}/generations/{name}/gens_*_{mode}.jsonl"],
+                model=model,
+            )
+
+        sorted_outputs = {
+            (mode, c): f"{results}/sorted-generations/{mode}/{name}-{c}.csv"
+            for mode in GENERATION_MODES
+            for c in stimuli
+        }
+        jobs[f"coalesce/{name}"] = Job(
+            f"coalesce/{name}",
+            "coalesce",
+            {
+                "generations_dir": f"{results}/generations",
+                "outdir": f"{results}/sorted-generations",
+                "arc_stimuli": stimuli["arc"],
+                "coord_stimuli": stimuli["coord"],
+                "models": [name],
+            },
+            deps=["stimuli"] + [f"generate/{name}/{mode}" for mode in GENERATION_MODES],
+            inputs=list(stimuli.values())
+            + [f"{results}/generations/{name}/gens_*_{mode}.jsonl" for mode in GENERATION_MODES],
+            outputs=list(sorted_outputs.values()),
+        )
+
+        for stage, mode in [("eval", "freeform"), ("rejection-eval", "rejection")]:
+            for condition in args.conditions:
+                jobs[f"{stage}/{name}/{condition}"] = Job(
+                    f"{stage}/{name}/{condition}",
+                    stage,
+                    {
+                        **scoring,
+                        "model": model,
+                        "mode": condition,
+                        "instruct": instruct,
+                        "sorted_dir": f"{results}/sorted-generations",
+                        "results_dir": f"{results}/dgrc/{mode}-{condition}",
+                    },
+                    deps=[f"coalesce/{name}"],
+                    inputs=[sorted_outputs[(mode, condition)]],
+                    outputs=[f"{results}/dgrc/{mode}-{condition}/{name}.csv"],
+                    model=model,
+                )
+
+    @functools.lru_cache(maxsize=None)
+    def selected_upstream(name):
+        return any(
+            jobs[dep].stage in args.stages or selected_upstream(dep) for dep in jobs[name].deps
+        )
+
+    # keep the requested stages and what they need. A job of another stage
+    # whose outputs are all there, and that nothing requested feeds into, is
+    # a source: its outputs are used as they are, whatever the manifest says,
+    # so that e.g. `eval` never resamples the committed generations.
+    needed, sources = set(), set()
+    stack = [name for name, job in jobs.items() if job.stage in args.stages]
+    while stack:
+        name = stack.pop()
+        job = jobs[name]
+        if name in needed or name in sources:
+            continue
+        if (
+            job.stage not in args.stages
+            and not selected_upstream(name)
+            and all(glob.glob(pattern) for pattern in job.outputs)
+        ):
+            print(f"{name}: kept as it is (not in --stages)")
+            sources.add(name)
+            continue
+        needed.add(name)
+        stack.extend(job.deps)
+
+    planned = []
+    for name, job in jobs.items():
+        if name in needed:
+            job.deps = [dep for dep in job.deps if dep in needed]
+            planned.append(job)
+    return planned
+
+
+class Manifest:
+    """fingerprints and outputs of finished jobs, plus a hash cache of the files."""
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs, self.files = {}, {}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self.jobs, self.files = manifest["jobs"], manifest["files"]
+
+    def digest(self, path):
+        """sha256 of a file, only re-read when its size or mtime changed."""
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known is not None and (known["size"], known["mtime_ns"]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return known["sha256"]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        self.files[path] = {
+            "sha256": sha.hexdigest(),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        return self.files[path]["sha256"]
+
+    def up_to_date(self, job, fingerprint):
+        known = self.jobs.get(job.name)
+        return (
+            known is not None
+            and known["fingerprint"] == fingerprint
+            and all(
+                os.path.exists(path) and self.digest(path) == sha
+                for path, sha in known["outputs"].items()
+            )
+        )
+
+    def record(self, job, fingerprint):
+        outputs = {
+            path: self.digest(path)
+            for pattern in job.outputs
+            for path in sorted(glob.glob(pattern))
+        }
+        self.jobs[job.name] = {"fingerprint": fingerprint, "outputs": outputs}
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with checkpoint.atomic_path(self.path) as tmp:
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"jobs": self.jobs, "files": self.files}, f, indent=1, sort_keys=True
+                )
+
+
+@functools.lru_cache(maxsize=None)
+def fingerprint(job, manifest):
+    options = {
+        name: value
+        for name, value in sorted(vars(cli.stage_args(job.stage, **job.options)).items())
+        if name not in RUNTIME_OPTIONS
+    }
+    inputs = {
+        path: manifest.digest(path)
+        for pattern in job.inputs
+        for path in sorted(glob.glob(pattern))
+    }
+    revision = score_cache.model_revision(job.model) if job.model is not None else None
+
+    key = json.dumps(
+        {"options": options, "inputs": inputs, "revision": revision}, sort_keys=True
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def run_job(stage, options):
+    cli.run(stage, **options)
+
+
+def build(jobs, manifest, devices=("cpu",), force=False, dry_run=False):
+    """
+    Runs the stale jobs, up to one per entry of `devices` at a time, and
+    records every finished one in `manifest`. Returns the names of the jobs
+    that failed (their dependents are skipped).
+    """
+    pending = list(jobs)
+    done, rebuilt, failed = set(), set(), []
+    free = list(devices)
+    running = {}
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(devices), mp_context=context) as executor:
+        while pending or running:
+            for job in list(pending):
+                if any(dep in failed for dep in job.deps):
+                    print(f"{job.name}: skipped, a dependency failed")
+                    failed.append(job.name)
+                    pending.remove(job)
+                    continue
+                if not all(dep in done for dep in job.deps):
+                    continue
+
+                if dry_run and any(dep in rebuilt for dep in job.deps):
+                    # inputs are not there yet to fingerprint
+                    print(f"{job.name}: stale (dependency rebuilt)")
+                    rebuilt.add(job.name)
+                    done.add(job.name)
+                    pending.remove(job)
+                    continue
+
+                key = fingerprint(job, manifest)
+                if not force and manifest.up_to_date(job, key):
+                    print(f"{job.name}: up to date")
+                    done.add(job.name)
+                    pending.remove(job)
+                    continue
+
+                if dry_run:
+                    print(f"{job.name}: stale")
+                    rebuilt.add(job.name)
+                    done.add(job.name)
+                    pending.remove(job)
+                    continue
+
+                if not free:
+                    break
+
+                device = free.pop(0)
+                options = job.options
+                if job.model is not None:
+                    options = dict(options, device=device)
+                    print(f"{job.name}: building on {device}")
+                else:
+                    print(f"{job.name}: building")
+                running[executor.submit(run_job, job.stage, options)] = (job, key, device)
+                pending.remove(job)
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job, key, device = running.pop(future)
+                free.append(device)
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"{job.name}: failed ({e!r})")
+                    failed.append(job.name)
+                    continue
+                manifest.record(job, key)
+                rebuilt.add(job.name)
+                done.add(job.name)
+                print(f"{job.name}: done")
+
+    return failed
+
+
+def main(args):
+    jobs = plan(args)
+    manifest = Manifest(f"{args.data_dir}/results/pipeline.json")
+    failed = build(jobs, manifest, args.devices, args.force, args.dry_run)
+    if failed:
+        raise RuntimeError(f"{len(failed)} job(s) failed or were skipped: {', '.join(failed)}")
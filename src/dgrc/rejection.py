@@ -0,0 +1,48 @@
+from dgrc import compare, instrument, templating
+from dgrc.headers import HEYWAIT_HEADER, NO, NO_HEADER, WAIT
+
+# names used in the header column of the results
+HEADER_NAMES = {NO_HEADER: "no", HEYWAIT_HEADER: "wait"}
+
+
+@instrument.timed("template")
+def build_stimuli(entries, tokenizer, headers, instruct=False):
+    """
+    Every sorted-generation row after each of the headers: the header names
+    for the results, the scored strings, and the keys of the prefixes they
+    share (one per preamble), all in row-major, header-minor order.
+    """
+    types = []
+    stimuli = []
+    prefix_keys = []
+    for entry in entries:
+        for header in headers:
+            if instruct:
+                stimulus = templating.render_chat(
+                    entry["preamble"],
+                    tok=tokenizer,
+                    response_prompt=f'{header} {entry["continuation"]}',
+                )
+            else:
+                stimulus = templating.dialog_template(
+                    name1=entry["name1"],
+                    name2=entry["name2"],
+                    preamble=entry["preamble"],
+                    response_prompt=f'{header} {entry["continuation"]}',
+                )
+            types.append(HEADER_NAMES.get(header, header))
+            stimuli.append(stimulus)
+            prefix_keys.append((entry["name1"], entry["name2"], entry["preamble"]))
+
+    return types, stimuli, prefix_keys
+
+
+def main(args):
+    headers = NO + WAIT if args.kim22_headers else args.headers
+
+    def build(entries, tokenizer):
+        types, stimuli, prefix_keys = build_stimuli(entries, tokenizer, headers, args.instruct)
+        print(list(zip(types, stimuli))[:4])
+        return stimuli, prefix_keys, {"header": types}, {"headers": headers}
+
+    compare.main(args, "rejection-eval", "rejection", build)
@@ -0,0 +1,130 @@
+"""
+Per-row sampling: lets a single `generate` call decode rows that each carry
+their own (top_p, top_k, temperature) config.
+
+The warper follows the semantics (and order) of transformers' own
+TemperatureLogitsWarper -> TopKLogitsWarper -> TopPLogitsWarper, but with a
+value per row. It is meant to be passed as a custom `logits_processor`, with
+the built-in warpers switched off (top_p=None, top_k=0, temperature=1.0), so
+that it runs right after the repetition penalty, as the built-in ones would.
+
+`PerRowSeededSampler` additionally gives every row its own random stream, so
+that samples don't depend on batch size or batch composition.
+"""
+
+import hashlib
+import torch
+
+from transformers import LogitsProcessor
+
+
+class PerRowSamplingWarper(LogitsProcessor):
+    """
+    top_p, top_k, temperature: one value per row of the generation batch
+    (i.e., already expanded by num_return_sequences). None disables the
+    corresponding filter for that row, like in `generate`.
+    """
+
+    def __init__(
+        self,
+        top_p,
+        top_k,
+        temperature,
+        filter_value=-float("inf"),
+        min_tokens_to_keep=1,
+    ):
+        self.top_p = torch.tensor([1.0 if p is None else float(p) for p in top_p])
+        self.top_k = torch.tensor([0 if k is None else int(k) for k in top_k])
+        self.temperature = torch.tensor(
+            [1.0 if t is None else float(t) for t in temperature]
+        )
+        self.filter_value = filter_value
+        self.min_tokens_to_keep = min_tokens_to_keep
+
+    def __call__(self, input_ids, scores):
+        device = scores.device
+        vocab_size = scores.size(-1)
+
+        # temperature
+        scores = scores / self.temperature.to(device, scores.dtype).unsqueeze(-1)
+
+        # top-k: 0 means no filtering
+        top_k = self.top_k.to(device)
+        top_k = torch.where(top_k > 0, top_k, torch.full_like(top_k, vocab_size))
+        top_k = top_k.clamp(min=self.min_tokens_to_keep, max=vocab_size)
+        kth = scores.topk(int(top_k.max()), dim=-1).values.gather(
+            -1, (top_k - 1).unsqueeze(-1)
+        )
+        scores = scores.masked_fill(scores < kth, self.filter_value)
+
+        # top-p: 1.0 means no filtering
+        top_p = self.top_p.to(device, scores.dtype)
+        sorted_logits, sorted_indices = scores.sort(descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p).unsqueeze(-1)
+        sorted_to_remove[..., -self.min_tokens_to_keep :] = False
+        sorted_to_remove[top_p >= 1.0] = False
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        scores = scores.masked_fill(to_remove, self.filter_value)
+
+        return scores
+
+    def select(self, rows):
+        """keeps only the given rows, for when finished rows leave the batch."""
+        rows = rows.cpu()
+        self.top_p = self.top_p[rows]
+        self.top_k = self.top_k[rows]
+        self.temperature = self.temperature[rows]
+
+
+def stream_seed(*key):
+    """
+    A stable 63-bit seed derived from `key`, e.g. (seed, item idx, vp type,
+    config, sample number). Unlike `hash`, this is the same in every process.
+    """
+    digest = hashlib.sha256(repr(key).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") >> 1
+
+
+class PerRowSeededSampler(LogitsProcessor):
+    """
+    Samples the next token of every row from its own torch.Generator, and
+    returns scores that put all the probability on that token, so that the
+    sampling step in `generate` just picks it.
+
+    Each row only ever consumes its own random stream (one draw per step), so
+    what a row generates doesn't depend on which rows it is batched with. It
+    has to be the last processor, i.e. the built-in warpers have to be off and
+    applied with `PerRowSamplingWarper` before it.
+    """
+
+    def __init__(self, seeds):
+        self.seeds = seeds
+        self.generators = None
+
+    def __call__(self, input_ids, scores):
+        if self.generators is None:
+            self.generators = [
+                torch.Generator(device=scores.device).manual_seed(seed)
+                for seed in self.seeds
+            ]
+
+        probs = scores.float().softmax(dim=-1)
+        chosen = torch.cat(
+            [
+                torch.multinomial(row, 1, generator=generator)
+                for row, generator in zip(probs, self.generators)
+            ]
+        )
+
+        sampled = torch.full_like(scores, -float("inf"))
+        sampled.scatter_(1, chosen.unsqueeze(-1), 0.0)
+        return sampled
+
+    def select(self, rows):
+        """keeps only the given rows, for when finished rows leave the batch."""
+        rows = rows.tolist()
+        if self.generators is None:
+            self.seeds = [self.seeds[i] for i in rows]
+        else:
+            self.generators = [self.generators[i] for i in rows]
@@ -0,0 +1,145 @@
+"""
+A persistent, content-addressed cache of sequence scores, kept in a SQLite
+file so that it can be shared across runs (and models).
+
+Scores are keyed by (model id, model revision, --backend, sha256 of the
+stimulus text, bow_correction flag), so re-running the Compare stage only
+scores the stimuli that haven't been seen before. Caches written before the
+backend was part of the key hold fp32 scores, and are migrated as such.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+from tqdm import tqdm
+
+
+def stimulus_hash(stimulus):
+    return hashlib.sha256(stimulus.encode("utf-8")).hexdigest()
+
+
+def model_revision(model, model_config=None):
+    """
+    The revision of `model`: for a local directory, a hash of its file names,
+    sizes and mtimes (so that retraining or replacing a checkpoint in place
+    changes it), else the hub commit of its config (`model_config`, loaded if
+    not given), or 'local' if there is none.
+    """
+    if os.path.isdir(model):
+        files = []
+        for root, _, names in os.walk(model):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append([os.path.relpath(path, model), stat.st_size, stat.st_mtime_ns])
+        return hashlib.sha256(json.dumps(sorted(files)).encode()).hexdigest()
+
+    if model_config is None:
+        from transformers import AutoConfig
+
+        model_config = AutoConfig.from_pretrained(model, trust_remote_code=True)
+    return getattr(model_config, "_commit_hash", None) or "local"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    model TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    stimulus TEXT NOT NULL,
+    bow_correction INTEGER NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (model, revision, backend, stimulus, bow_correction)
+)
+"""
+
+
+class ScoreCache:
+    def __init__(self, path, model, revision="local", backend="fp32"):
+        self.path = path
+        self.model = model
+        self.revision = revision
+        self.backend = backend
+        self.connection = sqlite3.connect(path)
+
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(scores)")]
+        if columns and "backend" not in columns:
+            # the key can't be altered in place; copy the fp32 scores over
+            self.connection.executescript(
+                f"""
+                ALTER TABLE scores RENAME TO scores_fp32;
+                {SCHEMA};
+                INSERT INTO scores
+                SELECT model, revision, 'fp32', stimulus, bow_correction, score
+                FROM scores_fp32;
+                DROP TABLE scores_fp32;
+                """
+            )
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def get(self, stimuli, bow_correction=False):
+        """returns {stimulus hash: score} for the stimuli that are cached."""
+        hashes = list({stimulus_hash(s) for s in stimuli})
+        found = {}
+        # stay under sqlite's limit on the number of query parameters
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i : i + 500]
+            rows = self.connection.execute(
+                f"""
+                SELECT stimulus, score FROM scores
+                WHERE model = ? AND revision = ? AND backend = ? AND bow_correction = ?
+                AND stimulus IN ({", ".join("?" * len(chunk))})
+                """,
+                [self.model, self.revision, self.backend, int(bow_correction), *chunk],
+            )
+            found.update(rows)
+        return found
+
+    def put(self, stimuli, scores, bow_correction=False):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    self.model,
+                    self.revision,
+                    self.backend,
+                    stimulus_hash(s),
+                    int(bow_correction),
+                    score,
+                )
+                for s, score in zip(stimuli, scores)
+            ],
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def cached_score(cache, stimuli, score_fn, bow_correction=False, chunk_size=1024):
+    """
+    Looks up `stimuli` in `cache` and only runs `score_fn` on the rows that are
+    missing. `score_fn(indices)` gets the positions (into `stimuli`) to score
+    and returns their scores in the same order; it is called on chunks of
+    `chunk_size` rows, and each chunk is written to the cache as soon as it
+    is done, so an interrupted run keeps what it has scored so far.
+
+    Returns the scores for all stimuli, in order.
+    """
+    found = cache.get(stimuli, bow_correction)
+    hashes = [stimulus_hash(s) for s in stimuli]
+    missing = [i for i, h in enumerate(hashes) if h not in found]
+    print(
+        f"Score cache: {len(stimuli) - len(missing)}/{len(stimuli)} stimuli already scored"
+    )
+
+    for start in tqdm(range(0, len(missing), chunk_size), disable=not missing):
+        chunk = missing[start : start + chunk_size]
+        scores = score_fn(chunk)
+        cache.put([stimuli[i] for i in chunk], scores, bow_correction)
+        found.update({hashes[i]: score for i, score in zip(chunk, scores)})
+
+    return [found[h] for h in hashes]
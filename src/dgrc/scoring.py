@@ -0,0 +1,365 @@
+"""
+Scoring helpers that sit on top of minicons' IncrementalLMScorer.
+
+The DGRC stimuli share long prefixes (chat template + system instruction +
+preamble) across many continuations, so instead of scoring each stimulus from
+token zero, we encode the shared prefix once and reuse its past-key-values
+for every continuation in the group. Scores are computed the same way as
+`lm.sequence_score(batch, bow_correction=...)` (mean token log-prob, first
+token ignored).
+
+`load_model` and `score_stimuli` are how `eval` and `rejection-eval` (see
+`compare`) load the scorer and score their stimuli.
+"""
+
+import copy
+import torch
+
+from dgrc import autobatch, backends, batching, instrument, logprobs, templating, utils
+from collections import defaultdict
+from minicons import scorer
+from tqdm import tqdm
+
+
+@instrument.timed("tokenize")
+def encode_stimuli(lm, stimuli):
+    """
+    tokenize stimuli the same way minicons does in `lm.encode`, without
+    padding, with the template pieces tokenized once (see `templating.encode`).
+    """
+    return templating.encode(lm.tokenizer, stimuli)
+
+
+def unique_rows(stimuli):
+    """
+    For exact-duplicate dedup: the positions of the first occurrence of every
+    distinct stimulus, and for every stimulus, the index of its first
+    occurrence in that list (so scores[inverse[i]] is the score of row i).
+    """
+    first = {}
+    unique, inverse = [], []
+    for i, stimulus in enumerate(stimuli):
+        if stimulus not in first:
+            first[stimulus] = len(unique)
+            unique.append(i)
+        inverse.append(first[stimulus])
+    return unique, inverse
+
+
+def common_prefix_length(sequences):
+    """length of the longest common token prefix of a list of id lists."""
+    shortest = min(len(s) for s in sequences)
+    length = 0
+    while length < shortest and all(
+        s[length] == sequences[0][length] for s in sequences
+    ):
+        length += 1
+    return length
+
+
+def bow_mass(lm, logprobs):
+    """log-probability mass of beginning-of-word tokens at each position."""
+    bow_idx = torch.tensor(lm.bow_subword_idx, device=logprobs.device)
+    return logprobs.index_select(-1, bow_idx).logsumexp(-1)
+
+
+def reduce_scores(lm, ids, token_logprobs, bow_logprobs=None, bow_correction=False):
+    """
+    Mirrors the per-token computation in minicons' `compute_stats`, followed by
+    the default mean reduction of `sequence_score`.
+
+    ids: full token ids of the sequence (length n)
+    token_logprobs: log p(ids[j+1] | ids[:j+1]) for j = 0..n-2
+    bow_logprobs: beginning-of-word mass of the distribution at j = 0..n-1
+    """
+    idx = ids[1:]
+    length = len(idx)
+    score = token_logprobs[:length]
+
+    if bow_correction and lm.is_bow_tokenizer:
+        mask_forward = torch.zeros(length, device=score.device)
+        for i in range(length):
+            if i == length - 1 or lm.bow_subwords[idx[i + 1]]:
+                mask_forward[i] = 1
+        mask_current = torch.roll(mask_forward, shifts=1)
+        mask_current[0] = 0.0
+
+        forward_correction = bow_logprobs[1 : length + 1]
+        current_correction = bow_logprobs[:length]
+
+        score = (
+            score
+            + (forward_correction * mask_forward)
+            - (current_correction * mask_current)
+        )
+
+    return score.mean(0).item()
+
+
+def _score_group(lm, ids, batch_size=8, bow_correction=False, max_tokens=None):
+    """
+    scores a group of tokenized sequences that share a token prefix. If
+    `max_tokens` is given, continuations are batched by token budget instead
+    of `batch_size`.
+    """
+    # keep at least one token per row outside the prefix, so that the
+    # continuation pass always has something to run on.
+    prefix_length = min(common_prefix_length(ids), min(len(i) for i in ids) - 1)
+    prefix_length = max(prefix_length, 1)
+    device = lm.model.device
+
+    with torch.no_grad():
+        prefix = torch.tensor([ids[0][:prefix_length]], device=device)
+        prefix_out = lm.model(input_ids=prefix, use_cache=True)
+        prefix_logprobs = prefix_out.logits[0].log_softmax(-1)
+        prefix_cache = prefix_out.past_key_values
+
+        # the prefix only predicts tokens inside the prefix, except for
+        # its last position, which predicts each row's first continuation token.
+        prefix_targets = torch.tensor(ids[0][1:prefix_length], device=device)
+        prefix_token_logprobs = prefix_logprobs[:-1].gather(
+            -1, prefix_targets.unsqueeze(-1)
+        ).squeeze(-1)
+        prefix_bow = bow_mass(lm, prefix_logprobs) if lm.is_bow_tokenizer else None
+
+        continuation_lengths = [len(i) - prefix_length for i in ids]
+        if max_tokens is None:
+            batches = batching.fixed_size_batches(len(ids), batch_size)
+        else:
+            batches = batching.token_budget_batches(continuation_lengths, max_tokens)
+
+        def score_batch(batch):
+            batch_ids = [ids[i] for i in batch]
+            continuations = [i[prefix_length:] for i in batch_ids]
+            longest = max(len(c) for c in continuations)
+
+            input_ids = torch.full(
+                (len(batch_ids), longest), lm.tokenizer.pad_token_id, device=device
+            )
+            attention_mask = torch.zeros(
+                (len(batch_ids), prefix_length + longest),
+                dtype=torch.long,
+                device=device,
+            )
+            attention_mask[:, :prefix_length] = 1
+            for row, c in enumerate(continuations):
+                input_ids[row, : len(c)] = torch.tensor(c, device=device)
+                attention_mask[row, prefix_length : prefix_length + len(c)] = 1
+
+            cache = copy.deepcopy(prefix_cache)
+            cache.batch_repeat_interleave(len(batch_ids))
+
+            logits = lm.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                use_cache=True,
+            ).logits
+            logprobs = logits.log_softmax(-1)
+
+            batch_scores = []
+            for row, (full, c) in enumerate(zip(batch_ids, continuations)):
+                row_logprobs = logprobs[row, : len(c)]
+                # first continuation token is predicted by the last prefix position
+                first = prefix_logprobs[-1, c[0]].unsqueeze(0)
+                rest = row_logprobs[:-1].gather(
+                    -1, torch.tensor(c[1:], device=device).unsqueeze(-1)
+                ).squeeze(-1)
+                token_logprobs = torch.cat([prefix_token_logprobs, first, rest])
+
+                bow_logprobs = None
+                if prefix_bow is not None:
+                    bow_logprobs = torch.cat([prefix_bow, bow_mass(lm, row_logprobs)])
+
+                batch_scores.append(
+                    reduce_scores(
+                        lm,
+                        full,
+                        token_logprobs,
+                        bow_logprobs,
+                        bow_correction=bow_correction,
+                    )
+                )
+            return batch_scores
+
+        def batch_tokens(batch):
+            return len(batch) * (prefix_length + max(continuation_lengths[i] for i in batch))
+
+        scores = [None] * len(ids)
+        for batch in batches:
+            # split (see `autobatch`) if it runs out of memory under --auto_batch
+            for i, score in zip(batch, autobatch.run(batch, score_batch, batch_tokens)):
+                scores[i] = score
+
+    return scores
+
+
+def prefix_sequence_score(
+    lm, keys, stimuli, batch_size=8, bow_correction=False, max_tokens=None
+):
+    """
+    Scores `stimuli` by grouping them on `keys` (anything hashable that
+    identifies a shared prefix, e.g. the preamble) and encoding each group's
+    common token prefix only once. Returns scores in the original order.
+
+    The shared prefix is determined on token ids rather than strings, so
+    merges across the prefix/continuation boundary can't change the result.
+    """
+    groups = defaultdict(list)
+    for i, key in enumerate(keys):
+        groups[key].append(i)
+
+    encoded = encode_stimuli(lm, stimuli)
+
+    scores = [None] * len(stimuli)
+    for key, rows in tqdm(groups.items()):
+        with instrument.step():
+            group_scores = _score_group(
+                lm,
+                [encoded[i] for i in rows],
+                batch_size=batch_size,
+                bow_correction=bow_correction,
+                max_tokens=max_tokens,
+            )
+        for i, score in zip(rows, group_scores):
+            scores[i] = score
+
+    return scores
+
+
+def generated_sequence_scores(lm, encoded, generated, step_logits, num_gen):
+    """
+    Sequence scores (mean token log-prob over prompt + continuation, first
+    token ignored) for sequences sampled with `lm.model.generate`, without
+    re-tokenizing and re-running them.
+
+    encoded: the left-padded prompt batch that was passed to `generate`
+    generated: the new tokens, shape (batch * num_gen, steps)
+    step_logits: the raw logits returned with `output_logits=True`, one
+        (batch * num_gen, vocab) tensor per step.
+
+    The prompt is scored once per item (not once per sample) and its
+    log-probs are shared by all `num_gen` samples. Special tokens (and
+    anything after the end of generation) are excluded, matching the decoded
+    strings that `skip_special_tokens=True` produces. These are scores of the
+    sampled tokens, not of the joined strings `generate.rescore` re-tokenizes.
+    """
+    input_ids = encoded["input_ids"]
+    attention_mask = encoded["attention_mask"]
+
+    with torch.no_grad():
+        # prompts are left padded, so positions have to follow the mask.
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        logits = lm.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+        ).logits
+        logprobs = logits[:, :-1].log_softmax(-1)
+        prompt_logprobs = logprobs.gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+        # only count targets whose context is a real token, i.e. skip padding
+        # and the first real token of every prompt.
+        prompt_mask = (attention_mask[:, 1:] * attention_mask[:, :-1]).to(
+            prompt_logprobs.dtype
+        )
+        prompt_sum = (prompt_logprobs * prompt_mask).sum(-1)
+        prompt_count = prompt_mask.sum(-1)
+
+        if step_logits:
+            step_logprobs = torch.stack(step_logits, dim=1).float().log_softmax(-1)
+            generated_logprobs = step_logprobs.gather(
+                -1, generated.unsqueeze(-1)
+            ).squeeze(-1)
+        else:
+            # nothing was sampled (max_new=0)
+            generated_logprobs = prompt_sum.new_zeros(generated.shape)
+
+        special = torch.tensor(lm.tokenizer.all_special_ids, device=generated.device)
+        is_special = torch.isin(generated, special)
+        # everything after the first special (eos/pad) token is padding.
+        finished = is_special.long().cumsum(-1) > 0
+        generated_mask = (~finished).to(generated_logprobs.dtype)
+        generated_sum = (generated_logprobs * generated_mask).sum(-1)
+        generated_count = generated_mask.sum(-1)
+
+    prompt_sum = prompt_sum.repeat_interleave(num_gen)
+    prompt_count = prompt_count.repeat_interleave(num_gen)
+
+    scores = (prompt_sum + generated_sum) / (prompt_count + generated_count)
+    return scores.tolist()
+
+
+@instrument.timed("score")
+def score_stimuli(lm, stimuli, prefix_keys, args):
+    """
+    The sequence scores (bow-corrected) of `stimuli`, the way `eval` and
+    `rejection-eval` score them with `args` (--share_prefix, --max_tokens,
+    --gather_logprobs, --verify_templates).
+    """
+    if args.verify_templates:
+        # tokenize every row the string way too, and compare
+        templating.verify(lm.tokenizer)
+
+    if args.share_prefix:
+        # encode each preamble once and reuse its kv-cache for all continuations
+        # (branching off at the header, in rejection-eval)
+        scores = prefix_sequence_score(
+            lm,
+            prefix_keys,
+            stimuli,
+            batch_size=args.batch_size,
+            bow_correction=True,
+            max_tokens=args.max_tokens,
+        )
+    elif args.max_tokens is not None:
+        # sort by length and pack batches up to a token budget
+        scores, _ = batching.budget_sequence_score(
+            lm,
+            stimuli,
+            args.max_tokens,
+            batch_size=args.batch_size,
+            bow_correction=True,
+            logprob_chunk=args.logprob_chunk if args.gather_logprobs else None,
+        )
+    else:
+        # not a DataLoader, which draws a seed from the global torch RNG, and
+        # would shift the seeded sampling of `stream` running next to it
+        input_ids = encode_stimuli(lm, stimuli)
+        batches = list(utils.divide_chunks(input_ids, args.batch_size))
+
+        scores = []
+
+        for batch in tqdm(batches):
+            with instrument.step():
+                with instrument.stage("pad"):
+                    encoded = lm.tokenizer.pad({"input_ids": batch}, return_tensors="pt")
+                if args.gather_logprobs:
+                    # only the log-probs of the scored tokens, in chunks
+                    score = logprobs.sequence_score(
+                        lm, encoded, bow_correction=True, chunk_size=args.logprob_chunk
+                    )
+                else:
+                    score = lm.sequence_score(encoded, bow_correction=True)
+            scores.extend(score)
+
+    if args.verify_templates:
+        templating.report(lm.tokenizer)
+
+    return scores
+
+
+def score_shard(lm, shard, args):
+    stimuli, prefix_keys = shard
+    return score_stimuli(lm, stimuli, prefix_keys, args)
+
+
+def load_model(model, device, backend="fp32"):
+    lm = scorer.IncrementalLMScorer(model, device=device, trust_remote_code=True)
+    backends.apply(lm.model, backend)
+
+    # minicons collects these from an unordered vocab dict; fix the order so the
+    # bow-corrected logsumexp (and hence the scores) is the same in every run.
+    if lm.is_bow_tokenizer:
+        lm.bow_subword_idx = sorted(lm.bow_subword_idx)
+
+    return lm
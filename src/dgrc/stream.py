@@ -0,0 +1,283 @@
+"""
+Steps 1-4 fused for one model: generated continuations are recombined with
+the ARC and COORD preambles and scored as they come in, instead of going
+through the generation files, `coalesce` and the sorted-generation csvs.
+
+The --sweep grid of each mode is run batch by batch, every config on the
+same batch of items, so the items of a batch are complete (all their
+samples are in) as soon as the batch is. Three stages then run at once,
+connected by bounded queues of --queue_size batches:
+
+    generation (main thread) -> recombination -> scoring
+
+Recombination keeps the top --sample unique continuations per (item, vp
+type) and joins them with the stimuli rows, like `coalesce`. Scoring
+templates and scores the rows like `eval` (freeform) and `rejection-eval`
+(rejection), on the weights of the generation model. Once everything is
+scored, the results are written to {results_dir}/{mode}-{condition}/{model}.csv
+in the order `eval`/`rejection-eval` write them. Generation files (in
+--outdir, with --write_generations) and sorted-generation csvs (in
+--sorted_dir) are only written when asked for.
+
+Generations are the same as those of `generate --sweep`: every batch is
+seeded on its own, or every row with --seeded_streams.
+"""
+
+import csv
+import pathlib
+import queue
+import threading
+
+import torch
+
+from dgrc import (
+    checkpoint,
+    coalesce,
+    evaluate,
+    generate,
+    models,
+    parallel,
+    rejection,
+    scoring,
+    utils,
+)
+from dgrc.headers import NO, WAIT
+from contextlib import ExitStack
+from minicons import scorer
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+# marks the end of a stage's input
+DONE = object()
+
+
+class Stage:
+    """
+    Calls `fn(item)` on every item put on a bounded queue, in a background
+    thread. An error is raised again by the next `put` or by `close`; the
+    items after it are dropped, so producers never block on a dead stage.
+    """
+
+    def __init__(self, fn, maxsize):
+        self.fn = fn
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.busy = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is DONE:
+                return
+            if self.error is None:
+                try:
+                    with parallel.Timer() as timer:
+                        self.fn(item)
+                    self.busy += timer.seconds
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def share_scorer(lm, model, device):
+    """
+    A scorer set up like `scoring.load_model` (right padding, sorted bow
+    ids) on the weights of the generation model `lm`, so that the model is
+    only loaded once.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model, trust_remote_code=True)
+    shared = scorer.IncrementalLMScorer(lm.model, device=device, tokenizer=tokenizer)
+    if shared.is_bow_tokenizer:
+        shared.bow_subword_idx = sorted(shared.bow_subword_idx)
+    return shared
+
+
+def score_rows(lm, mode, entries, args):
+    """
+    Scores sorted-generation rows as `eval` (freeform) or `rejection-eval`
+    (rejection) would, and returns the result rows of every entry: [(score,)],
+    or [(header, score)] for each header.
+    """
+    if mode == "rejection":
+        headers = NO + WAIT if args.kim22_headers else args.headers
+        types, stimuli, prefix_keys = rejection.build_stimuli(
+            entries, lm.tokenizer, headers, args.instruct
+        )
+    else:
+        headers = [None]
+        stimuli, prefix_keys = evaluate.build_stimuli(entries, lm.tokenizer, args.instruct)
+
+    if args.dedup:
+        rows, inverse = scoring.unique_rows(stimuli)
+        scores = scoring.score_stimuli(
+            lm, [stimuli[i] for i in rows], [prefix_keys[i] for i in rows], args
+        )
+        scores = [scores[j] for j in inverse]
+    else:
+        scores = scoring.score_stimuli(lm, stimuli, prefix_keys, args)
+
+    n = len(headers)
+    if mode == "rejection":
+        results = list(zip(types, scores))
+    else:
+        results = [(score,) for score in scores]
+    return [results[i : i + n] for i in range(0, len(results), n)]
+
+
+def recombine(records, stimuli, sample):
+    """
+    Joins the top `sample` continuations of every (item, vp type) in
+    `records` [(config, idx, decoded vp1, decoded vp2)] with the stimuli of
+    each condition. Returns {condition: [(vp type, idx, row)]}, each in the
+    order of the sorted-generation csv.
+    """
+    generations = coalesce.Generations()
+    for _, i, d1, d2 in records:
+        for vp, decoded in (("vp1", d1), ("vp2", d2)):
+            for sentence, logprob in decoded:
+                generations.add(i, vp, sentence, logprob)
+
+    top = generations.top(sample)
+    joined = {}
+    for condition, condition_stimuli in stimuli.items():
+        rows = list(coalesce.joined_rows(condition_stimuli, generations, top))
+        vp_column = len(condition_stimuli[0])
+        item_column = condition_stimuli[0].index("item")
+        joined[condition] = [
+            (coalesce.VP_TYPES.index(row[vp_column]), int(row[item_column]), row)
+            for row in rows
+        ]
+    return joined
+
+
+def write_sorted(path, header, rows):
+    pathlib.Path(path).parent.mkdir(exist_ok=True, parents=True)
+    with checkpoint.atomic_path(path) as tmp:
+        with open(tmp, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+def main(args):
+    lm = generate.load_model(args.model, args.device, args.backend)
+    score_lm = share_scorer(lm, args.model, args.device)
+    name = models.savename(args.model)
+
+    analysis_data = utils.read_csv_dict(args.analysis_data)
+    stimuli = {
+        condition: coalesce.read_stimuli(getattr(args, f"{condition}_stimuli"))
+        for condition in args.conditions
+    }
+
+    # {(mode, condition): [(vp type, idx, row, result rows)]}
+    results = {}
+    counts = {"generated": 0, "scored": 0, "recombining": 0.0}
+
+    def score(item):
+        mode, joined = item
+        for condition, rows in joined.items():
+            header = coalesce.joined_header(stimuli[condition])
+            entries = [dict(zip(header, row)) for _, _, row in rows]
+            scored = score_rows(score_lm, mode, entries, args) if entries else []
+            results.setdefault((mode, condition), []).extend(
+                (vp, i, row, result) for (vp, i, row), result in zip(rows, scored)
+            )
+            counts["scored"] += len(entries)
+
+    scorer_stage = Stage(score, args.queue_size)
+
+    def recombine_batch(item):
+        mode, records = item
+        scorer_stage.put((mode, recombine(records, stimuli, args.sample)))
+
+    with parallel.Timer() as timer:
+        for mode in args.sweep_modes:
+            response = (args.response or generate.REJECTION) if mode == "rejection" else None
+            mode_stimuli = generate.build_stimuli(
+                analysis_data, lm.tokenizer, instruct=args.instruct, response=response
+            )
+            batches = generate.encode_batches(
+                lm.tokenizer, mode_stimuli, args.batch_size, args.device
+            )
+            grid = generate.sweep_grid(args, mode)
+            print(f"mode: {mode}, {len(grid)} configs x {len(batches)} batches")
+
+            recombine_stage = Stage(recombine_batch, args.queue_size)
+            with ExitStack() as stack:
+                adders = {}
+                if args.write_generations:
+                    pathlib.Path(args.outdir).mkdir(exist_ok=True, parents=True)
+                    adders = {
+                        config: stack.enter_context(
+                            generate.open_results(
+                                f"{args.outdir}/{outfile}",
+                                generate.results_meta(args, config, response),
+                            )
+                        )
+                        for config, outfile in grid.items()
+                    }
+
+                for batch in tqdm(batches):
+                    records = []
+                    for config in grid:
+                        record = generate.generate_batch(lm, batch, args, response, config)
+                        if config in adders:
+                            for _, i, d1, d2 in record:
+                                adders[config](i, "vp1", d1)
+                                adders[config](i, "vp2", d2)
+                        records.extend(record)
+                    counts["generated"] += 2 * len(batch[0]) * len(grid)
+                    recombine_stage.put((mode, records))
+
+                recombine_stage.close()
+                counts["recombining"] += recombine_stage.busy
+
+        scorer_stage.close()
+
+    print(
+        f"Generated {counts['generated']} rows and scored {counts['scored']} in "
+        f"{timer.seconds:.1f}s; scoring was busy for {scorer_stage.busy:.1f}s, "
+        f"recombination for {counts['recombining']:.1f}s"
+    )
+    parallel.report_throughput(
+        "dgrc-stream",
+        1,
+        torch.get_num_threads(),
+        counts["generated"],
+        timer.seconds,
+        args.throughput_report,
+    )
+
+    for (mode, condition), rows in results.items():
+        # the order of the sorted-generation csv: by vp type, then item, and
+        # within an item, as joined (the sort is stable)
+        rows.sort(key=lambda row: (row[0], row[1]))
+
+        if args.sorted_dir is not None:
+            write_sorted(
+                f"{args.sorted_dir}/{mode}/{name}-{condition}.csv",
+                coalesce.joined_header(stimuli[condition]),
+                [row for _, _, row, _ in rows],
+            )
+
+        results_dir = f"{args.results_dir}/{mode}-{condition}"
+        pathlib.Path(results_dir).mkdir(exist_ok=True, parents=True)
+        with checkpoint.atomic_path(f"{results_dir}/{name}.csv") as tmp:
+            utils.write_csv(
+                data=[result for *_, scored in rows for result in scored],
+                path=tmp,
+                header=["header", "score"] if mode == "rejection" else ["score"],
+            )
@@ -0,0 +1,280 @@
+"""
+Prompt templates shared by `generate`, `eval` and `rejection-eval`, and a
+faster way to build and tokenize them.
+
+`chat_template` and `dialog_template` are the string path: the chat template
+is rendered by `tok.apply_chat_template` for every row, and the result is
+tokenized as a whole. The system instruction and the template around the
+preamble and reply are the same for every row, so
+
+- `render_chat` renders the chat template once per tokenizer (and per kind
+  of prompt), around placeholders, and fills the rows into it;
+- `encode` tokenizes a prompt piece by piece, between the special tokens of
+  the template. Special tokens are split off before the rest of the text is
+  tokenized, so the pieces tokenize the same on their own as within the
+  prompt. The pieces before the last special token (the system turn, each
+  preamble's user turn) are shared by many rows, and the most recent
+  MAX_PIECES of them are kept tokenized; the last piece (the reply, or the
+  whole of a dialog prompt) is different for every row and is tokenized
+  directly.
+
+Both are checked against the string path: `render_chat` on a probe row when
+a scaffold is first rendered, `encode` on the first prompt of each tokenizer
+and on every prompt that brings in a piece not in the cache, or a reply that
+starts with whitespace right after a special token (or on every prompt, with
+`verify`). Every piece a prompt is built from has thus been checked within a
+whole prompt once. If a template or tokenizer does not keep to the above,
+they fall back to the string path.
+"""
+
+import functools
+import re
+
+from string import Template
+
+INSTRUCTION = "Please respond to the following message as naturally as possible, using a single sentence, as if we were talking to each other. Please keep it short."
+
+TEMPLATE = Template('$name1 said, "$preamble", and $name2 replied, "')
+
+# placeholders for the rows when rendering a chat scaffold
+SENTENCE = "\x00sentence\x00"
+RESPONSE = "\x00response\x00"
+
+# rows to render and check the chat scaffolds with
+PROBE = ("The probe is here.", "Sure, it is")
+
+# shared prompt pieces kept tokenized, per tokenizer
+MAX_PIECES = 4096
+
+
+def chat_template(sentence, tok, response_prompt=None):
+    """
+    A function that applies the model's chat template to simulate
+    an interaction environment. Two possible options
+    """
+    if response_prompt is None:
+        return tok.apply_chat_template(
+            [
+                {
+                    "role": "system",
+                    "content": INSTRUCTION,
+                },
+                {"role": "user", "content": sentence},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+    else:
+        return tok.apply_chat_template(
+            [
+                {
+                    "role": "system",
+                    "content": INSTRUCTION,
+                },
+                {"role": "user", "content": sentence},
+                {"role": "assistant", "content": response_prompt},
+            ],
+            tokenize=False,
+            continue_final_message=True,
+        )
+
+
+"""
+default:
+
+System: blah
+User: blah <end>
+
+
+add_generation_prompt = True
+
+System: blah
+User: blah
+Assistant:
+
+continue_final_message=False,
+System: blah
+User: blah
+Assistant: blah <end_assistant_turn>
+
+continue_final_message=True,
+System: blah
+User: blah
+Assistant: blah
+
+"""
+
+
+def dialog_template(name1, name2, preamble, response_prompt=None):
+    substituted = TEMPLATE.substitute(name1=name1, name2=name2, preamble=preamble)
+    if response_prompt is None:
+        return substituted
+    else:
+        return f"{substituted}{response_prompt}"
+
+
+def fill(scaffold, sentence, response_prompt=None):
+    if response_prompt is None:
+        head, tail = scaffold
+        return f"{head}{sentence}{tail}"
+    head, middle, tail = scaffold
+    return f"{head}{sentence}{middle}{response_prompt}{tail}"
+
+
+@functools.lru_cache(maxsize=None)
+def chat_scaffold(tok, continued):
+    """
+    The chat template of `tok` around a sentence (and a reply to continue, if
+    `continued`), as the text before, between and after them. None if the
+    template doesn't keep them verbatim.
+    """
+    response = RESPONSE if continued else None
+    text = chat_template(SENTENCE, tok, response)
+    if text.count(SENTENCE) != 1 or (continued and text.count(RESPONSE) != 1):
+        return None
+
+    head, rest = text.split(SENTENCE)
+    scaffold = (head, *rest.split(RESPONSE)) if continued else (head, rest)
+
+    sentence, response = PROBE
+    response = response if continued else None
+    if fill(scaffold, sentence, response) != chat_template(sentence, tok, response):
+        return None
+    return scaffold
+
+
+def render_chat(sentence, tok, response_prompt=None):
+    """`chat_template`, filled into a scaffold rendered once per tokenizer."""
+    # chat templates may strip the messages
+    scaffold = None
+    if sentence == sentence.strip() and (
+        response_prompt is None or response_prompt == response_prompt.strip()
+    ):
+        scaffold = chat_scaffold(tok, response_prompt is not None)
+    if scaffold is None:
+        return chat_template(sentence, tok, response_prompt)
+    return fill(scaffold, sentence, response_prompt)
+
+
+class Encoder:
+    """
+    Tokenizes prompts for one tokenizer, by the text between its special
+    tokens, with the shared pieces tokenized once (up to MAX_PIECES of them).
+    """
+
+    def __init__(self, tokenizer, add_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.add_special_tokens = add_special_tokens
+        self.verify = False
+        self.encoded = 0
+        self.split = True
+        self.mismatches = 0
+        self.piece = functools.lru_cache(maxsize=MAX_PIECES)(self.tokenize_piece)
+        # whether the prompt being encoded brought in a piece not in the cache
+        self.new_piece = False
+
+        specials = sorted(
+            set(tokenizer.all_special_tokens) | set(tokenizer.get_added_vocab()),
+            key=len,
+            reverse=True,
+        )
+        self.special_ids = {token: tokenizer.convert_tokens_to_ids(token) for token in specials}
+        self.pattern = None
+        if specials:
+            self.pattern = re.compile("(" + "|".join(map(re.escape, specials)) + ")")
+
+        # the tokens the tokenizer adds around a text (e.g. bos)
+        self.head, self.tail = [], []
+        if add_special_tokens:
+            plain = tokenizer("a", add_special_tokens=False).input_ids
+            full = tokenizer("a").input_ids
+            starts = [
+                i for i in range(len(full) - len(plain) + 1) if full[i : i + len(plain)] == plain
+            ]
+            if starts:
+                self.head, self.tail = full[: starts[0]], full[starts[0] + len(plain) :]
+            else:
+                self.split = False
+
+    def reference(self, text):
+        return self.tokenizer(text, add_special_tokens=self.add_special_tokens).input_ids
+
+    def tokenize(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def tokenize_piece(self, text):
+        self.new_piece = True
+        return self.tokenize(text)
+
+    def split_encode(self, text):
+        """the ids of `text` from its pieces, and whether they need checking."""
+        parts = [text] if self.pattern is None else self.pattern.split(text)
+        ids = list(self.head)
+        self.new_piece = False
+        check = False
+        for j, part in enumerate(parts):
+            if j % 2:
+                ids.append(self.special_ids[part])
+            elif j == len(parts) - 1:
+                # the row's own text, not worth keeping; whitespace next to a
+                # special token may be stripped or merged differently
+                ids.extend(self.tokenize(part) if part else [])
+                check = j > 0 and part[:1].isspace()
+            elif part:
+                ids.extend(self.piece(part))
+        ids.extend(self.tail)
+        return ids, check or self.new_piece
+
+    def __call__(self, texts):
+        encoded = []
+        for text in texts:
+            if not self.split:
+                encoded.append(self.reference(text))
+                continue
+
+            ids, check = self.split_encode(text)
+            if self.verify or check or self.encoded == 0:
+                reference = self.reference(text)
+                if ids != reference:
+                    self.mismatches += 1
+                    if not self.verify:
+                        print(
+                            "templating: the tokenizer doesn't split on its special "
+                            "tokens as expected, tokenizing whole prompts instead"
+                        )
+                        self.split = False
+                    ids = reference
+            self.encoded += 1
+            encoded.append(ids)
+        return encoded
+
+
+@functools.lru_cache(maxsize=None)
+def encoder(tokenizer, add_special_tokens=True):
+    return Encoder(tokenizer, add_special_tokens)
+
+
+def encode(tokenizer, texts, add_special_tokens=True):
+    """
+    `tokenizer(list(texts), add_special_tokens=...).input_ids`, from cached
+    pieces (see `Encoder`).
+    """
+    return encoder(tokenizer, add_special_tokens)(texts)
+
+
+def verify(tokenizer, on=True):
+    """
+    Checks every prompt `tokenizer` encodes against the string path from now
+    on, and uses the string path for the ones that differ.
+    """
+    for add_special_tokens in (True, False):
+        encoder(tokenizer, add_special_tokens).verify = on
+
+
+def report(tokenizer):
+    """prints how many checked prompts tokenized differently from the string path."""
+    mismatches = sum(
+        encoder(tokenizer, add_special_tokens).mismatches
+        for add_special_tokens in (True, False)
+    )
+    print(f"templating: {mismatches} prompt(s) tokenized differently from the string path")
@@ -0,0 +1,249 @@
+"""
+A per-token surprisal store, so that scores can be re-analyzed (other
+reductions, bow_correction on/off, sub-span sums) without running the LM
+again.
+
+A store is a directory of flat, memory-mapped columns, one entry per token
+of every row, concatenated in row order:
+
+    token_ids.int32    token ids (as encoded by `lm.encode`, with specials)
+    logprobs.float16   log p(ids[j] | ids[:j]); 0 for the first token
+    bow.float16        beginning-of-word mass of the distribution at j
+    is_bow.uint8       whether ids[j] starts a word
+    offsets.int64      row i spans [offsets[i], offsets[i + 1])
+    meta.json          model, revision, number of rows/tokens, ...
+
+bow and is_bow are only filled in for tokenizers with beginning-of-word
+tokens (meta["bow"]), and are all zeros otherwise.
+"""
+
+import json
+import os
+import pathlib
+import shutil
+import torch
+
+import numpy as np
+
+from dgrc import autobatch, batching, instrument, scoring
+from tqdm import tqdm
+
+COLUMNS = {
+    "token_ids": np.int32,
+    "logprobs": np.float16,
+    "bow": np.float16,
+    "is_bow": np.uint8,
+}
+
+
+def _file(path, column):
+    return pathlib.Path(path) / f"{column}.{np.dtype(COLUMNS[column]).name}"
+
+
+class TokenStoreWriter:
+    """
+    Appends rows to a new store at `path`, or, after `reserve`, writes them
+    in any order with `put`. Everything is written to `{path}.tmp` and moved
+    into place by `close`, so a crash never leaves a partial store behind.
+    """
+
+    def __init__(self, path, meta=None):
+        self.path = pathlib.Path(path)
+        self.tmp = pathlib.Path(f"{path}.tmp")
+        self.meta = meta or {}
+
+        if self.tmp.exists():
+            shutil.rmtree(self.tmp)
+        self.tmp.mkdir(parents=True)
+
+        self.files = {column: open(_file(self.tmp, column), "wb") for column in COLUMNS}
+        self.offsets = [0]
+        # memory-mapped columns, once rows are reserved
+        self.maps = None
+
+    def append(self, token_ids, logprobs, bow, is_bow):
+        """adds one row; all four arguments have one entry per token."""
+        for column, values in zip(COLUMNS, (token_ids, logprobs, bow, is_bow)):
+            np.asarray(values, dtype=COLUMNS[column]).tofile(self.files[column])
+        self.offsets.append(self.offsets[-1] + len(token_ids))
+
+    def reserve(self, lengths):
+        """
+        Lays out rows of `lengths` tokens (all the rows of the store) up
+        front, so that `put` can write them as they come, in any order.
+        """
+        self.offsets = [0, *np.cumsum(lengths, dtype=np.int64).tolist()]
+        self.maps = {}
+        for column, f in self.files.items():
+            f.truncate(self.offsets[-1] * np.dtype(COLUMNS[column]).itemsize)
+            f.flush()
+            if self.offsets[-1]:
+                self.maps[column] = np.memmap(f.name, dtype=COLUMNS[column], mode="r+")
+
+    def put(self, i, token_ids, logprobs, bow, is_bow):
+        """writes reserved row i; all four arguments have one entry per token."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        for column, values in zip(COLUMNS, (token_ids, logprobs, bow, is_bow)):
+            self.maps[column][start:end] = values
+
+    def close(self):
+        if self.maps:
+            for values in self.maps.values():
+                values.flush()
+        self.maps = None
+        for f in self.files.values():
+            f.close()
+        np.asarray(self.offsets, dtype=np.int64).tofile(self.tmp / "offsets.int64")
+
+        self.meta.update({"rows": len(self.offsets) - 1, "tokens": self.offsets[-1]})
+        with open(self.tmp / "meta.json", "w") as f:
+            json.dump(self.meta, f)
+
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        os.replace(self.tmp, self.path)
+
+
+class TokenStore:
+    """
+    Read-only view of a store. Columns are memory-mapped, so slicing a few
+    rows only reads those rows from disk.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+
+        self.offsets = np.fromfile(self.path / "offsets.int64", dtype=np.int64)
+        self.columns = {column: self._map(column) for column in COLUMNS}
+
+    def _map(self, column):
+        if self.meta["tokens"] == 0:
+            return np.zeros(0, dtype=COLUMNS[column])
+        return np.memmap(_file(self.path, column), dtype=COLUMNS[column], mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def row(self, i, column="logprobs"):
+        """the values of `column` for every token of row i."""
+        return self.columns[column][self.offsets[i] : self.offsets[i + 1]]
+
+    def token_ids(self, i):
+        return self.row(i, "token_ids")
+
+    def logprobs(self, i):
+        return self.row(i, "logprobs")
+
+    def span_sums(self, rows, starts, ends):
+        """
+        Sums of token log-probs over token positions [start, end) of each row,
+        e.g. to get the surprisal of the continuation only.
+        """
+        logprobs = self.columns["logprobs"]
+        return np.array(
+            [
+                logprobs[self.offsets[i] + start : self.offsets[i] + end].sum(
+                    dtype=np.float64
+                )
+                for i, start, end in zip(rows, starts, ends)
+            ]
+        )
+
+    def sequence_scores(self, bow_correction=False):
+        """
+        Recomputes `lm.sequence_score` (mean log-prob, first token ignored)
+        for every row, with or without bow_correction, from the stored columns.
+        Matches `scoring.reduce_scores` up to float16 rounding.
+        """
+        logprobs = self.columns["logprobs"].astype(np.float64)
+        lengths = self.lengths()
+        position = np.arange(self.meta["tokens"]) - np.repeat(self.offsets[:-1], lengths)
+
+        contribution = logprobs
+        if bow_correction and self.meta["bow"]:
+            bow = self.columns["bow"].astype(np.float64)
+            is_bow = np.append(self.columns["is_bow"].astype(bool), False)
+            last = position == np.repeat(lengths, lengths) - 1
+            # forward correction wherever the next token starts a word (or at
+            # the end), current correction wherever the token itself does.
+            forward = last | is_bow[1:]
+            current = (position >= 2) & is_bow[:-1]
+            previous_bow = np.concatenate([[0.0], bow[:-1]])
+            contribution = logprobs + bow * forward - previous_bow * current
+
+        contribution = np.where(position >= 1, contribution, 0.0)
+        sums = np.add.reduceat(contribution, self.offsets[:-1]) if len(self) else []
+        return (np.asarray(sums) / (lengths - 1)).tolist()
+
+
+@instrument.timed("score")
+def score_to_store(
+    lm, stimuli, writer, batch_size=8, max_tokens=None, bow_correction=False
+):
+    """
+    Runs the LM over `stimuli` (fixed-size batches, or token-budget batches if
+    `max_tokens` is given), writes every row's per-token columns to `writer`,
+    in order, and returns the sequence scores, computed in full precision the
+    same way as `lm.sequence_score`. Rows are written to the store as soon as
+    their batch is scored.
+    """
+    input_ids = scoring.encode_stimuli(lm, stimuli)
+    lengths = [len(ids) for ids in input_ids]
+    if max_tokens is None:
+        batches = batching.fixed_size_batches(len(stimuli), batch_size)
+    else:
+        batches = batching.token_budget_batches(lengths, max_tokens)
+
+    device = lm.model.device
+
+    def score_batch(batch):
+        with instrument.stage("pad"):
+            encoded = lm.tokenizer.pad(
+                {"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt"
+            ).to(device)
+        logprobs = lm.model(**encoded).logits.log_softmax(-1)
+        bow = scoring.bow_mass(lm, logprobs) if lm.is_bow_tokenizer else None
+
+        scored = []
+        for row, i in enumerate(batch):
+            ids = input_ids[i]
+            n = len(ids)
+            targets = torch.tensor(ids[1:], device=device)
+            token_logprobs = (
+                logprobs[row, : n - 1].gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+            )
+            row_bow = bow[row, :n] if bow is not None else None
+
+            score = scoring.reduce_scores(
+                lm, ids, token_logprobs, row_bow, bow_correction=bow_correction
+            )
+            columns = (
+                ids,
+                np.concatenate([[0.0], token_logprobs.cpu().numpy()]),
+                row_bow.cpu().numpy() if row_bow is not None else np.zeros(n),
+                [bool(lm.bow_subwords[t]) for t in ids] if row_bow is not None else np.zeros(n),
+            )
+            scored.append((score, columns))
+        return scored
+
+    def batch_tokens(batch):
+        return len(batch) * max(lengths[i] for i in batch)
+
+    writer.reserve(lengths)
+    scores = [None] * len(stimuli)
+    with torch.no_grad():
+        for batch in tqdm(batches):
+            with instrument.step():
+                # split (see `autobatch`) if it runs out of memory under --auto_batch
+                scored = autobatch.run(batch, score_batch, batch_tokens)
+            with instrument.stage("write"):
+                for i, (score, columns) in zip(batch, scored):
+                    scores[i] = score
+                    writer.put(i, *columns)
+
+    return scores
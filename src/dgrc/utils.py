@@ -15,6 +15,45 @@ def read_jsonl(path):
     return data
 
 
+def iter_jsonl(path):
+    """like read_jsonl, but yields one line at a time instead of reading the whole file."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_generations(path):
+    """
+    Yields one {"idx", "vp", "sample", "sentence", "logprob"} record per
+    generated sample in a `dgrc generate` output, reading .jsonl files
+    line by line. Legacy .json files (one dict with generation_vp1/vp2 lists)
+    are loaded whole and yield the same records.
+    """
+    if str(path).endswith(".jsonl"):
+        for record in iter_jsonl(path):
+            if "meta" not in record:
+                yield record
+        return
+
+    # not read_json, which prints and returns None on errors
+    with open(path, encoding="utf-8") as f:
+        try:
+            generations = json.load(f)
+        except json.JSONDecodeError as error:
+            raise ValueError(f"{path} is not a valid generations file: {error}") from error
+    for vp in ("vp1", "vp2"):
+        for item in generations[f"generation_{vp}"]:
+            for i, (sentence, logprob) in enumerate(item["sentences"]):
+                yield {
+                    "idx": item["idx"],
+                    "vp": vp,
+                    "sample": i,
+                    "sentence": sentence,
+                    "logprob": logprob,
+                }
+
+
 def read_csv_dict(path):
     data = []
     with open(path, "r") as f: